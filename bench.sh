@@ -0,0 +1,8 @@
+#!/bin/sh
+#
+# Run the container benchmarks, writing JSON results to bench_output.txt
+#
+# Pass --quick for smaller sizes, or --compare FILE to compare with an
+# earlier run
+#
+exec python bench/bench_container.py --output bench_output.txt "$@"
@@ -0,0 +1,179 @@
+"""
+Benchmarks for pato.container.
+
+    ./bench.sh                      # writes bench_output.txt
+    ./bench.sh --quick -k lookup    # smaller sizes, only matching benchmarks
+    ./bench.sh --compare old.json   # show change against an earlier run
+
+Results are written as JSON, one entry per benchmark with the time per
+operation in seconds (best, median and mean over the repeats), so that
+runs from different commits can be compared.  Services are synthetic:
+each is built by calling dict() with a couple of plain values and
+references to other services, so the times are dominated by the
+container itself rather than by the factories.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import argparse, json, os, platform, subprocess, sys, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pato.container import Container, import_name
+
+timer = getattr(time, "perf_counter", time.time)
+
+def name(i):
+    return "svc/%d" % i
+
+def tree_config(n):
+    """n services, each depending on its 'parent' i//2 (a balanced binary tree)"""
+    config = {name(0): {":": "dict", "x": 0}}
+    for i in range(1, n):
+        config[name(i)] = {":": "dict", "x": i, "parent": "<%s>" % name(i // 2),
+                           "tags": ["a", "b"]}
+    return config
+
+def deep_config(depth):
+    """A chain of services, each depending on the previous one"""
+    config = {name(0): {":": "dict", "x": 0}}
+    for i in range(1, depth):
+        config[name(i)] = {":": "dict", "prev": "<%s>" % name(i - 1)}
+    return config
+
+def wide_config(width):
+    """One service depending on width leaf services"""
+    config = dict((name(i), {":": "dict", "x": i}) for i in range(1, width + 1))
+    config[name(0)] = {":": "dict", "items": ["<%s>" % name(i) for i in range(1, width + 1)]}
+    return config
+
+def container(config):
+    c = Container()
+    c.load_dict(config)
+    return c
+
+def measure(func, ops, repeat, setup=None):
+    """Call setup() then time func(), repeat times; return times per op"""
+    times = []
+    for _ in range(repeat):
+        state = setup() if setup else None
+        start = timer()
+        func(state)
+        times.append((timer() - start) / ops)
+    return times
+
+def bench_lookup_hot(n, repeat):
+    c = container(tree_config(n))
+    c.resolve_all()
+    names = [name(i) for i in range(n)] * max(1, 100000 // n)
+    def run(state):
+        for k in names:
+            c[k]
+    return measure(run, len(names), repeat)
+
+def bench_resolve_all(n, repeat):
+    config = tree_config(n)
+    return measure(lambda c: c.resolve_all(), n, repeat, lambda: container(config))
+
+def bench_expire_rebuild(n, repeat):
+    c = container(tree_config(n))
+    c.resolve_all()
+    def run(state):
+        c.expire()
+        c.resolve_all()
+    return measure(run, n, repeat)
+
+def bench_deep(depth, repeat):
+    config = deep_config(depth)
+    return measure(lambda c: c[name(depth - 1)], depth, repeat, lambda: container(config))
+
+def bench_wide(width, repeat):
+    config = wide_config(width)
+    return measure(lambda c: c[name(0)], width + 1, repeat, lambda: container(config))
+
+def bench_import_name(n, repeat):
+    def run(state):
+        for _ in range(n):
+            import_name("os.path.join")
+    return measure(run, n, repeat)
+
+def bench_cold_start(threads, repeat, n=1000):
+    """threads threads all calling resolve_all() on a new container at once"""
+    config = tree_config(n)
+    def setup():
+        c = container(config)
+        go = threading.Event()
+        workers = [threading.Thread(target=lambda: (go.wait(), c.resolve_all()))
+                   for _ in range(threads)]
+        for t in workers:
+            t.start()
+        return go, workers
+    def run(state):
+        go, workers = state
+        go.set()
+        for t in workers:
+            t.join()
+    return measure(run, n, repeat, setup)
+
+def benchmarks(quick):
+    sizes = (10, 1000) if quick else (10, 1000, 10000)
+    for n in sizes:
+        yield "lookup_hot", n, bench_lookup_hot
+        yield "resolve_all", n, bench_resolve_all
+        yield "expire_rebuild", n, bench_expire_rebuild
+    # each level of a chain uses several stack frames
+    yield "deep", 50 if quick else 200, bench_deep
+    yield "wide", 1000 if quick else 10000, bench_wide
+    yield "import_name", 10000, bench_import_name
+    for threads in (1, 4) if quick else (1, 4, 16):
+        yield "cold_start_threads", threads, bench_cold_start
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except Exception:
+        return None
+
+def load_results(filename):
+    with open(filename) as f:
+        return dict(((r["name"], r["size"]), r) for r in json.load(f)["results"])
+
+def compare(results, old):
+    for r in results:
+        prev = old.get((r["name"], r["size"]))
+        if prev:
+            change = (r["min"] / prev["min"] - 1) * 100
+            print("%-20s %6d %+7.1f%%" % (r["name"], r["size"], change), file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark pato.container")
+    parser.add_argument("--quick", action="store_true", help="use smaller sizes")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("-k", dest="filter", help="only run benchmarks whose name contains this")
+    parser.add_argument("--output", help="write JSON results to this file (default stdout)")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args(argv)
+    old = load_results(args.compare) if args.compare else None
+
+    results = []
+    for (bench, size, func) in benchmarks(args.quick):
+        if args.filter and args.filter not in bench:
+            continue
+        times = sorted(func(size, args.repeat))
+        results.append(dict(name=bench, size=size, repeat=len(times), min=times[0],
+                            median=times[len(times) // 2], mean=sum(times) / len(times)))
+        print("%-20s %6d %12.3fus" % (bench, size, times[0] * 1e6), file=sys.stderr)
+
+    report = dict(commit=git_commit(), python=platform.python_version(),
+                  implementation=platform.python_implementation(), time=time.time(),
+                  results=results)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if old is not None:
+        compare(results, old)
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 #!/bin/sh
 header="from __future__ import absolute_import, division, print_function, unicode_literals"
 
-for d in pato test libtest examples; do
+for d in pato test libtest examples bench; do
   find "$d" -name '*.py' | while read f; do
     if [ -s "$f" ]; then
       if ! grep "^$header\$" "$f" >/dev/null; then
@@ -0,0 +1,99 @@
+"""
+An asyncio version of pato.soap.SOAPReceiver (requires python 3.5+)
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import asyncio, functools, inspect, sys, weakref
+from pato.soap import SOAPReceiver
+import xmltodict
+
+# get_running_loop is new in python 3.7
+running_loop = getattr(asyncio, "get_running_loop", asyncio.get_event_loop)
+
+class ServerBusy(RuntimeError):
+    pass
+
+class AsyncSOAPReceiver(SOAPReceiver):
+    """
+    Like SOAPReceiver, but must be awaited:
+
+        text = await receiver(body)
+
+    The app may be a coroutine function (or return an awaitable).  A
+    plain function is called directly, so it should not block.
+
+    Requests larger than offload_size characters are parsed, and their
+    responses serialised, in the given concurrent.futures executor so
+    they do not stall the event loop.  If executor is None then the
+    loop's default thread pool is used; a ProcessPoolExecutor also works.
+
+    If max_in_flight is set, at most that many requests are processed at
+    once and the rest wait their turn.  If acquire_timeout is also set,
+    a request which has waited that many seconds is rejected with a
+    ServerBusy fault.  The limit applies separately to each event loop
+    which uses the receiver.
+
+    For the ctx.exc_info / ctx.error signalling to work with concurrent
+    requests, ctx should be a pato.local.ContextLocal rather than a
+    thread-local.
+    """
+
+    def __init__(self, app, executor=None, offload_size=65536,
+                 max_in_flight=None, acquire_timeout=None, **kwargs):
+        super(AsyncSOAPReceiver, self).__init__(app, **kwargs)
+        self.executor = executor
+        self.offload_size = offload_size
+        self.max_in_flight = max_in_flight
+        self.acquire_timeout = acquire_timeout
+        self.semaphores = weakref.WeakKeyDictionary()     # {event loop: Semaphore}
+
+    async def run(self, offload, func, *args, **kwargs):
+        """Run func either inline or in the executor"""
+        if not offload:
+            return func(*args, **kwargs)
+        loop = running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def acquire(self):
+        """Wait for a turn, and return the semaphore to release afterwards"""
+        # A semaphore belongs to the loop which first waits on it
+        loop = running_loop()
+        semaphore = self.semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self.semaphores[loop] = asyncio.Semaphore(self.max_in_flight)
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise ServerBusy("Too many requests in progress")
+        return semaphore
+
+    async def __call__(self, text):
+        soap_version = None
+        semaphore = None
+        offload = len(text) >= self.offload_size
+        try:
+            if self.max_in_flight:
+                semaphore = await self.acquire()
+            data = await self.run(offload, xmltodict.parse, text, **self.parse_options)
+            soap_version, body = self.unwrap(data)
+            if soap_version is None:
+                if self.ctx:
+                    self.ctx.exc_info = None
+                    self.ctx.error = True
+                return "Missing SOAP Envelope"
+            res = self.invoke(body, soap_version)
+            if inspect.isawaitable(res):
+                res = await res
+            return await self.run(offload, xmltodict.unparse,
+                                  self.envelope(res, soap_version), **self.unparse_options)
+
+        except Exception:
+            if not self.trap_exception: raise
+            exc_info = sys.exc_info()
+            if self.ctx:
+                self.ctx.exc_info = exc_info
+                self.ctx.error = True
+            return self.render_fault(exc_info, soap_version)
+        finally:
+            if semaphore is not None:
+                semaphore.release()
@@ -0,0 +1,85 @@
+"""
+Utilities for using pato with SQLAlchemy's asyncio extension
+(requires python 3.7+ and SQLAlchemy 1.4+)
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+from contextlib import asynccontextmanager
+from pato.local import get_actx
+from pato.sqla import configure_engine, SENTINEL
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine as real_create_async_engine
+from sqlalchemy.orm import sessionmaker
+import inspect
+
+def create_async_engine(*args, **kwargs):
+    """
+    Create an AsyncEngine with the same backend workarounds and pool
+    statistics as pato.sqla.create_engine.  The statistics are in
+    engine.sync_engine.pool_stats
+    """
+    pool_stats = kwargs.pop("pool_stats", None)
+    engine = real_create_async_engine(*args, **kwargs)
+    configure_engine(engine.sync_engine, pool_stats)
+    return engine
+
+class AsyncSessionManager(object):
+    """
+    The asyncio equivalent of pato.sqla.SessionManager.  By default the
+    session is set on pato.local.actx, whose attributes are separate for
+    each asyncio task; a task started inside the block sees the same
+    session, but an AsyncSession must not be used by two tasks at once.
+    The default session factory sets expire_on_commit=False, as
+    recommended for asyncio, so that objects can be used after commit
+    without implicit IO.
+
+    sessionmgr = AsyncSessionManager(engine)
+    ...
+    async with sessionmgr() as session:
+        ... await session.execute(...)
+    """
+
+    def __init__(self, engine, session_factory=None, ctx_factory=get_actx, attribute_name="db"):
+        self.engine = engine
+        self.session_factory = session_factory or \
+            sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+        self.ctx_factory = ctx_factory
+        self.attribute_name = attribute_name
+
+    @asynccontextmanager
+    async def __call__(self, ctx=None, force_new=False):
+        """
+        An async context manager which creates a database session, then
+        commits or rolls it back and closes it.  As with SessionManager,
+        an existing session in ctx is reused unless force_new is True.
+        """
+        if not ctx: ctx = self.ctx_factory()
+        old_session = getattr(ctx, self.attribute_name, SENTINEL)
+        if old_session is not SENTINEL and old_session is not None and not force_new:
+            yield old_session
+        else:
+            session = self.session_factory()
+            setattr(ctx, self.attribute_name, session)
+            try:
+                yield session
+                await session.commit()
+            except BaseException:
+                await session.rollback()
+                raise
+            finally:
+                await session.close()
+                if old_session is SENTINEL:
+                    delattr(ctx, self.attribute_name)
+                else:
+                    setattr(ctx, self.attribute_name, old_session)
+
+    async def invoke(self, service, *args, **kwargs):
+        """
+        Call a function or coroutine function inside a session
+
+        await sessionmgr.invoke(myservice, arg1, arg2)
+        """
+        async with self():
+            res = service(*args, **kwargs)
+            if inspect.isawaitable(res):
+                res = await res
+            return res
@@ -1,10 +1,26 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
-import importlib, os, six, threading
+import copy, hashlib, importlib, logging, os, pickle, six, struct, sys, threading, time, weakref
+
+SENTINEL = object()
+
+log = logging.getLogger(__name__)
+timer = getattr(time, "perf_counter", time.time)
+
+import_cache = {}   # {name: (module, [attribute names])}
 
 def import_name(name):
     """
     Resolve a name like some.module.someclass.method
+
+    Once a name has been resolved, which part of it is the module is
+    remembered, so that later calls do not repeat the failed imports
+    (e.g. of 'some.module.someclass').
     """
+    try:
+        (module, attrs) = import_cache[name]
+        return six.moves.reduce(getattr, attrs, module)
+    except KeyError:
+        pass
     module = six.moves.builtins
     (modname, attrs) = (name, [])
     while modname:
@@ -14,7 +30,28 @@ def import_name(name):
         except ImportError:
             modname, _, nattr = modname.rpartition(".")
             attrs.insert(0, nattr)
-    return six.moves.reduce(getattr, attrs, module)
+    res = six.moves.reduce(getattr, attrs, module)
+    import_cache[name] = (module, attrs)
+    return res
+
+def lazy_module(name):
+    """
+    Return a module which is not actually loaded until one of its
+    attributes is used (python 3.5+).  Use this in place of a module-level
+    import of a large package which is only sometimes needed.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    import importlib.util
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("No module named '%s'" % name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
 
 def raise_and_annotate(err, message):
     """
@@ -27,6 +64,101 @@ def raise_and_annotate(err, message):
     err.args = (err.args or ()) + (message,)
     raise
 
+class BuildTimeout(RuntimeError):
+    """A factory did not return within the time allowed"""
+    pass
+
+class ResolveError(Exception):
+    """
+    Raised by resolve_all(keep_going=True); errors is a dict of
+    {service name: exception} for every service which failed
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        super(ResolveError, self).__init__("%d service(s) failed: %s" % (
+            len(errors), "; ".join("%s: %s" % (name, errors[name]) for name in sorted(errors))))
+
+def call_with_timeout(func, args, kwargs, timeout):
+    """
+    Call func(*args, **kwargs) in a separate thread and wait for up to
+    timeout seconds for it to finish.  Python threads cannot be killed, so
+    if it does not finish, BuildTimeout is raised and the thread is left
+    to run to completion in the background, its result discarded.
+    """
+    result = []
+    def run():
+        try:
+            result.append((True, func(*args, **kwargs)))
+        except BaseException:
+            result.append((False, sys.exc_info()))
+    thread = threading.Thread(target=run, name="pato-build")
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    if not result:
+        raise BuildTimeout("Factory did not return within %.3g seconds" % timeout)
+    ok, value = result[0]
+    if ok:
+        return value
+    six.reraise(*value)
+
+def copy_exception(err, args):
+    """Return a copy of an exception with the given args"""
+    try:
+        err = copy.copy(err)
+    except Exception:
+        pass
+    err.args = args
+    return err
+
+def references(value):
+    """
+    Return the set of service names which a definition refers to
+    """
+    if isinstance(value, six.string_types):
+        if value[0:1] == "<" and value[0:2] != "<<" and ">" in value:
+            return {value[1:].rpartition(">")[0]}
+    elif isinstance(value, dict):
+        return set().union(*[references(v) for v in six.itervalues(value)])
+    elif isinstance(value, list):
+        return set().union(*[references(v) for v in value])
+    return set()
+
+def file_version(filename):
+    """Return a value which changes when the file is modified, or None if it does not exist"""
+    try:
+        st = os.stat(filename)
+    except (IOError, OSError):
+        return None
+    return (st.st_mtime, st.st_size)
+
+EXPORT_MAGIC = b"pato-export-1\n"
+
+def pack_export(content):
+    """Serialise a dict, with a checksum"""
+    payload = pickle.dumps(content, pickle.HIGHEST_PROTOCOL)
+    return EXPORT_MAGIC + hashlib.sha256(payload).hexdigest().encode("ascii") + b"\n" + payload
+
+def unpack_export(data):
+    """The reverse of pack_export"""
+    data = bytes(data)
+    if not data.startswith(EXPORT_MAGIC):
+        raise ValueError("Not a container export")
+    (digest, _, payload) = data[len(EXPORT_MAGIC):].partition(b"\n")
+    if hashlib.sha256(payload).hexdigest().encode("ascii") != digest:
+        raise ValueError("Container export is corrupt")
+    return pickle.loads(payload)
+
+class Source(object):
+    """A set of definitions loaded into a Container, from a file or directly"""
+    __slots__ = ("filename", "required", "version", "data")
+
+    def __init__(self, filename, required, version, data):
+        self.filename = filename
+        self.required = required
+        self.version = version
+        self.data = data
+
 class Container(object):
     """
     A container which allows you to request a service by name.  A 'service' is
@@ -68,37 +200,384 @@ class Container(object):
     c.resolve_all()  # optional
     c['customer'].get(123)
 
+    A factory which hangs, e.g. connecting to an unreachable host, would
+    hold the container lock and block every other thread.  To prevent
+    this, give a factory a timeout in seconds:
+
+    sql_engine:
+        :: sqlalchemy.create_engine
+        :timeout: 10
+        name_or_url: postgresql://db.example.com/myapp
+
+    or pass build_timeout to the Container, which limits the time taken to
+    build a service including all of its dependencies.  A factory with a
+    timeout is run in a separate thread; if it does not return in time,
+    BuildTimeout is raised and the thread is abandoned.  Lookups of that
+    service in the next retry_after seconds raise the same error at once.
+    Note that such a factory cannot itself look up services which have
+    not been built yet, because the lock is held by the waiting thread.
+
+    Other errors are raised afresh on each lookup, unless failure_backoff
+    is set: then a failed service is not retried for that many seconds,
+    doubling with each consecutive failure up to max_backoff, so that an
+    outage of a backend does not mean rebuilding the whole dependency
+    chain on every request.  failed() shows which services are broken.
+
+    A service with the option ":executor: process" is built and run in
+    worker processes, and looking it up gives a proxy; see pato.process.
+
     For more background to this approach see
     <https://gist.github.com/blairanderson/8072d951a480a590f0bd>
     """
 
-    def __init__(self, factory_key=":"):
+    def __init__(self, factory_key=":", build_timeout=None, timeout_key=":timeout",
+                 retry_after=30, failure_backoff=0, max_backoff=300, executor_key=":executor"):
         self.definitions = {}    # {service name: configuration}
         self.services = {}       # {service name: constructed object}
+        self.sources = []        # [Source], in the order loaded
+        self.builds = {}         # {service name: number of times built}
+        self.failures = {}       # {service name: (retry time, exception, count)}
+        self.derived = {}        # {service name: {attribute path: (service, value)}}
+        self.parent = None       # see child()
+        self.local = None        # in a child, the services not shared with the parent
         self.factory_key = factory_key
+        self.build_timeout = build_timeout
+        self.timeout_key = timeout_key
+        self.retry_after = retry_after
+        self.failure_backoff = failure_backoff
+        self.max_backoff = max_backoff
+        self.executor_key = executor_key
+        self.process_host = None        # see pato.process
+        self.host_owner = None          # container whose process_host this one uses
+        self.host_finalizer = None
+        self.host_lock = threading.Lock()
+        self.memory = None              # see pato.memory
+        self.imports = {}               # {service name: (seconds, [modules first imported])}
+        self.imported_by = {}           # {module name: service name}
+        self.build_times = []           # stack of time spent building dependencies
         self.lock = threading.RLock()   # for thread-safety
         self.building = set()           # for loop detection
+        self.plan = None                # build order, see from_export()
+        self.deadline = None            # while building, if build_timeout is set
 
     def load_yaml_file(self, filename, required=True):
         """Import the named YAML file of service definitions"""
+        filename = os.path.expanduser(filename)
+        version = file_version(filename)
+        data = self.read_yaml_file(filename, required)
+        self.sources.append(Source(filename, required, version, data))
+        self.apply(data)
+
+    def read_yaml_file(self, filename, required=True):
         try:
-            with open(os.path.expanduser(filename)) as stream:
-                self.load_yaml(stream)
+            with open(filename) as stream:
+                return self.parse_yaml(stream)
         except IOError:
             if required:
                 raise
 
+    def parse_yaml(self, stream):
+        import yaml
+        return yaml.load(stream, Loader=getattr(yaml, "FullLoader", yaml.Loader))
+
     def load_yaml(self, stream):
         """Import a YAML string or stream of service definitions"""
-        import yaml
-        self.load_dict(yaml.load(stream))
+        self.load_dict(self.parse_yaml(stream))
 
     def load_dict(self, data):
         """Import a dict of {service: definition}"""
         if data:   # allow for empty YAML files
+            self.sources.append(Source(None, False, None, dict(data)))
+            self.apply(data)
+
+    def apply(self, data):
+        if data:
+            self.plan = None    # no longer covers every definition
             self.definitions.update(data)
             for key in data:
-                self.services.pop(key, None)
+                self.forget(key)
+            self.localise(data)
+
+    def reload(self, force=False):
+        """
+        Re-read any YAML files which have changed since they were loaded
+        (or all of them, if force is True).  Only the services whose
+        definition has changed, or which depend directly or indirectly on
+        one which has, are replaced.  Those which had already been built
+        are rebuilt before the new definitions take effect, so that other
+        threads continue to use the old objects in the meantime; if
+        building fails, the exception is raised and nothing is changed.
+
+        Returns the set of service names which were replaced.
+        """
+        sources = []
+        reread = False
+        for source in self.sources:
+            if source.filename is not None:
+                version = file_version(source.filename)
+                if force or version != source.version:
+                    data = self.read_yaml_file(source.filename, source.required)
+                    source = Source(source.filename, source.required, version, data)
+                    reread = True
+            sources.append(source)
+        if not reread:
+            return set()
+
+        definitions = {}
+        for source in sources:
+            if source.data:
+                definitions.update(source.data)
+        old_definitions = self.definitions
+        changed = set(name for name in set(definitions) | set(old_definitions)
+                      if definitions.get(name, SENTINEL) != old_definitions.get(name, SENTINEL))
+        affected = self.dependents(changed, definitions) | \
+            self.dependents(changed, old_definitions)
+
+        # Build replacements in a separate container, which shares the
+        # unaffected services
+        shadow = self._similar()
+        shadow.memory = self.memory
+        shadow.host_owner = self
+        shadow.definitions = definitions
+        shadow.services = dict((name, service) for (name, service) in six.iteritems(self.services)
+                               if name not in affected)
+        for name in affected:
+            if name in self.services and name in definitions:
+                shadow[name]
+
+        with self.lock:
+            self.sources = sources
+            self.definitions = definitions
+            self.plan = None
+            for name in affected:
+                self.forget(name)
+            for (name, service) in six.iteritems(shadow.services):
+                self.services.setdefault(name, service)
+        return affected
+
+    def dependents(self, names, definitions=None):
+        """
+        Return the given service names together with the names of all
+        services which depend on them, directly or indirectly
+        """
+        if definitions is None:
+            definitions = self.definitions
+        users = {}    # {service name: set of services which refer to it}
+        for (name, value) in six.iteritems(definitions):
+            for ref in references(value):
+                users.setdefault(ref, set()).add(name)
+        result = set(names)
+        todo = list(result)
+        while todo:
+            for user in users.get(todo.pop(), ()):
+                if user not in result:
+                    result.add(user)
+                    todo.append(user)
+        return result
+
+    def child(self, overrides=None):
+        """
+        Return a container which has the same definitions as this one
+        except for the given overrides, e.g. per-tenant credentials:
+
+        tenant = c.child({"crm/password": "abc123"})
+        tenant["crm"]
+
+        Only the overridden services and those which depend on them,
+        directly or indirectly, are built by the child; lookups of any
+        other service go to this container, so those objects are shared.
+        Definitions added to the child later are treated as overrides too.
+
+        The child takes a (shallow) copy of the definitions, so later
+        changes to this container's definitions, including reload(), are
+        not seen by the child's own services.
+        """
+        child = self._similar()
+        child.parent = self
+        child.host_owner = self
+        child.local = set()
+        child.definitions = dict(self.definitions)
+        child.load_dict(overrides)
+        return child
+
+    def settings(self):
+        """Return the constructor arguments of this container"""
+        return dict(factory_key=self.factory_key, build_timeout=self.build_timeout,
+                    timeout_key=self.timeout_key, retry_after=self.retry_after,
+                    failure_backoff=self.failure_backoff, max_backoff=self.max_backoff,
+                    executor_key=self.executor_key)
+
+    def _similar(self):
+        """Return an empty container with the same settings as this one"""
+        return Container(**self.settings())
+
+    def requirements(self, names):
+        """
+        Return the given service names together with the names of all the
+        services which they depend on, directly or indirectly
+        """
+        result = set()
+        todo = list(names)
+        while todo:
+            name = todo.pop()
+            if name in result:
+                continue
+            if name not in self.definitions:
+                raise ValueError("Undefined service '%s'" % name)
+            result.add(name)
+            todo.extend(references(self.definitions[name]))
+        return result
+
+    def validate(self, names=None):
+        """
+        Return a list of problems with the definitions of the given
+        services (default all): references to undefined services, and
+        loops
+        """
+        return self._plan(names)[0]
+
+    def _plan(self, names=None):
+        """Return (problems, the order to build services in)"""
+        definitions = self.definitions
+        problems = []
+        order = []
+        state = {}      # {name: 1 while visiting, 2 when done}
+        for name in sorted(definitions if names is None else names):
+            # depth-first search without recursion, so deep graphs are fine
+            stack = [(name, None)]
+            while stack:
+                (node, refs) = stack.pop()
+                if refs is None:
+                    if state.get(node) == 2:
+                        continue
+                    if node not in definitions:
+                        problems.append("Undefined service '%s'" % node)
+                        state[node] = 2
+                        continue
+                    state[node] = 1
+                    refs = sorted(references(definitions[node]))
+                if refs:
+                    ref = refs.pop()
+                    stack.append((node, refs))
+                    if state.get(ref) == 1:
+                        problems.append("Loop detected at service '%s'" % ref)
+                    elif state.get(ref) != 2:
+                        stack.append((ref, None))
+                else:
+                    state[node] = 2
+                    order.append(node)
+        return problems, order
+
+    def export(self, names=None, plan=False):
+        """
+        Return the merged definitions as bytes, which another process can
+        turn back into an identical container with from_export(), without
+        reading or parsing any YAML.  If names are given, only those
+        services and the ones they depend on are exported.  The
+        definitions are checked first and ValueError raised if any
+        reference is undefined or there is a loop.
+
+        With plan=True, the order in which to build the services
+        (dependencies first) is included; the new container's
+        resolve_all() follows it, until any definitions are changed.
+
+        The data is pickled, so only load exports you created.
+        """
+        (problems, order) = self._plan(names)
+        if problems:
+            raise ValueError("Cannot export: %s" % "; ".join(problems))
+        if names is None:
+            definitions = dict(self.definitions)
+        else:
+            definitions = dict((name, self.definitions[name]) for name in self.requirements(names))
+        return pack_export(dict(settings=self.settings(), definitions=definitions,
+                                plan=order if plan else None))
+
+    @classmethod
+    def from_export(cls, data, prefetch=False):
+        """
+        Create a container from the result of export().  If prefetch is
+        True, the factories are imported in a background thread.
+        """
+        content = unpack_export(data)
+        container = cls(**content["settings"])
+        container.load_dict(content["definitions"])
+        container.plan = content["plan"]
+        if prefetch:
+            container.prefetch()
+        return container
+
+    def export_shared(self, name=None, **kwargs):
+        """
+        Export into a new multiprocessing.shared_memory.SharedMemory block
+        (python 3.8+), which worker processes can load with
+        Container.attach_shared(block.name).  The caller owns the block,
+        and should close() and unlink() it when the workers have started.
+        """
+        from multiprocessing import shared_memory
+        data = self.export(**kwargs)
+        block = shared_memory.SharedMemory(name=name, create=True, size=len(data) + 8)
+        block.buf[0:8] = struct.pack("<Q", len(data))
+        block.buf[8:8 + len(data)] = data
+        return block
+
+    @classmethod
+    def attach_shared(cls, name, **kwargs):
+        """Create a container from a shared memory block made by export_shared()"""
+        from multiprocessing import shared_memory
+        block = shared_memory.SharedMemory(name=name)
+        try:
+            (size,) = struct.unpack("<Q", bytes(block.buf[0:8]))
+            data = bytes(block.buf[8:8 + size])
+        finally:
+            block.close()
+        return cls.from_export(data, **kwargs)
+
+    def localise(self, names):
+        """In a child, stop sharing the given services and their dependents"""
+        if self.parent is not None:
+            for name in self.dependents(names):
+                self.local.add(name)
+                self.forget(name)
+
+    def report(self):
+        """
+        Return a dict describing the services and how many times each
+        has been built, to show how much a child shares with its parent:
+
+        definitions: number of definitions
+        built: number of services held by this container
+        builds: {service name: times built by this container}
+        derived: number of remembered attribute path values
+        size: approximate bytes used by this container's dicts and the
+              services it holds (not counting objects they refer to)
+        overridden: in a child, the number of services not shared
+        shared: in a child, the number of parent services currently used
+        """
+        with self.lock:
+            services = list(six.itervalues(self.services))
+            res = dict(
+                definitions=len(self.definitions),
+                built=len(services),
+                builds=dict(self.builds),
+                derived=sum(len(paths) for paths in six.itervalues(self.derived)),
+                size=sys.getsizeof(self.definitions) + sys.getsizeof(self.services) +
+                    sum(sys.getsizeof(service) for service in services),
+            )
+        if self.parent is not None:
+            res["overridden"] = len(self.local)
+            res["shared"] = len([name for name in self.parent.services
+                                 if name not in self.local and name in self.definitions])
+        return res
+
+    def watch(self, interval=2.0, on_reload=None):
+        """
+        Start a background thread which calls reload() every interval
+        seconds.  Returns the Watcher; call its stop() method to end it.
+        """
+        watcher = Watcher(self, interval, on_reload)
+        watcher.start()
+        return watcher
 
     def expire(self):
         """
@@ -106,32 +585,82 @@ class Container(object):
         (however, any object which has existing objects open
         will continue to use the old objects)
         """
-        self.services.clear()
+        for name in list(self.services):
+            self.forget(name)
+        self.failures.clear()
+        self.derived.clear()
 
-    def resolve_all(self):
+    def resolve_all(self, keep_going=False):
         """
         Resolve all services 'eagerly'. Call this if you want to ensure your
         startup overhead is completed up-front, or to catch errors early
         before your server forks and runs.
+
+        Normally the first error is raised.  With keep_going=True, every
+        service is tried and then a ResolveError is raised which lists
+        all of the services which failed.
         """
-        for key in self.definitions:
-            self.__getitem__(key)
+        errors = {}
+        for key in list(self.plan or self.definitions):
+            try:
+                self.__getitem__(key)
+            except Exception as err:
+                if not keep_going:
+                    raise
+                errors[key] = err
+        if errors:
+            raise ResolveError(errors)
         return self.services
 
+    def failed(self):
+        """
+        Return {service name: (exception, number of consecutive failures,
+        seconds until the next attempt)} for the services whose last build
+        failed and was remembered
+        """
+        now = time.time()
+        return dict((name, (err, count, max(0, retry - now)))
+                    for (name, (retry, err, count)) in list(six.iteritems(self.failures)))
+
+    def clear_failures(self, name=None):
+        """
+        Forget remembered failures, so the next lookup tries again.  If
+        name is given, the failures of the services which depend on it
+        are forgotten too.
+        """
+        if name is None:
+            self.failures.clear()
+        else:
+            for dependent in self.dependents([name]):
+                self.failures.pop(dependent, None)
+
     def __setitem__(self, name, definition):
         """
         Re-define a service. Does not affect existing objects, but future
         attempts to lookup this object will return a new instance.
         """
+        if not self.sources or self.sources[-1].filename is not None:
+            self.sources.append(Source(None, False, None, {}))
+        self.sources[-1].data[name] = definition
         self.definitions[name] = definition
-        self.services.pop(name, None)
+        self.plan = None
+        self.forget(name)
+        self.localise([name])
+
+    def forget(self, name):
+        """Drop a built service and anything remembered about it"""
+        service = self.services.pop(name, SENTINEL)
+        if service is not SENTINEL and self.memory is not None:
+            self.memory.retire(name, service)
+        self.failures.pop(name, None)
+        self.derived.pop(name, None)
 
     def __delitem__(self, name):
         """
         Remove an object. Next retrieval from container will get a
         fresh object.
         """
-        self.services.pop(name, None)
+        self.forget(name)
 
     def __contains__(self, name):
         """
@@ -149,24 +678,227 @@ class Container(object):
         try:
             return self.services[name]
         except KeyError:
+            if self.parent is not None and name not in self.local:
+                return self.parent[name]
+            self._check_failure(name)
             with self.lock:
                 self.building.clear()
-                return self._resolve_service(name)
+                if self.deadline is not None or not self.build_timeout:
+                    return self._resolve_service(name)
+                # The deadline covers building all the dependencies
+                self.deadline = time.time() + self.build_timeout
+                try:
+                    return self._resolve_service(name)
+                finally:
+                    self.deadline = None
 
     def _resolve_service(self, name):
         if name in self.services:
             return self.services[name]
+        if self.parent is not None and name not in self.local:
+            return self.parent[name]
         if name not in self.definitions:
             raise ValueError("Undefined service '%s'" % name)
         if name in self.building:
             raise ValueError("Loop detected while resolving service '%s'" % name)
+        self._check_failure(name)
         self.building.add(name)
+        first_module = len(sys.modules)
+        start = timer()
+        self.build_times.append(0.0)
         try:
-            self.services[name] = service = self._resolve_value(self.definitions[name])
+            if self.memory is not None:
+                service = self.memory.build(name, self._build, name)
+            else:
+                service = self._build(name)
+            self.services[name] = service
         except Exception as err:
+            self._record_failure(name, err, "While resolving service '%s'" % name)
             raise_and_annotate(err, "While resolving service '%s'" % name)
+        finally:
+            self._record_imports(name, first_module, timer() - start)
+        self.builds[name] = self.builds.get(name, 0) + 1
+        self.failures.pop(name, None)
         return service
 
+    def _record_imports(self, name, first_module, elapsed):
+        """
+        Note the modules which were first imported while building a
+        service, not counting those imported by its dependencies
+        """
+        dependencies = self.build_times.pop()
+        if self.build_times:
+            self.build_times[-1] += elapsed
+        if len(sys.modules) > first_module:
+            # sys.modules is in the order modules were imported
+            new = [m for m in list(sys.modules)[first_module:] if m not in self.imported_by]
+            if new:
+                for module in new:
+                    self.imported_by[module] = name
+                self.imports[name] = (elapsed - dependencies, new)
+
+    def import_report(self):
+        """
+        Return [(seconds, service name, [modules])] for the services whose
+        building first imported some modules, slowest first.  The time is
+        that taken to build the service itself, excluding its dependencies.
+        Imports made by other threads at the same time may be included.
+        """
+        return sorted(((t, name, modules) for (name, (t, modules)) in
+                       list(six.iteritems(self.imports))), reverse=True)
+
+    def factory_names(self):
+        """
+        Return {service name: set of factory names} for the factories
+        given as strings, such as 'sqlalchemy.create_engine', without
+        importing anything
+        """
+        def scan(value, found):
+            if isinstance(value, dict):
+                factory = value.get(self.factory_key)
+                if isinstance(factory, list) and factory:
+                    factory = factory[0]
+                if isinstance(factory, six.string_types) and factory[0:1] != "<":
+                    found.add(factory)
+                for v in six.itervalues(value):
+                    scan(v, found)
+            elif isinstance(value, list):
+                for v in value:
+                    scan(v, found)
+            return found
+        res = {}
+        for (name, value) in list(six.iteritems(self.definitions)):
+            found = scan(value, set())
+            if found:
+                res[name] = found
+        return res
+
+    def prefetch(self, names=None, background=True):
+        """
+        Import the factories of the given services (default all), so that
+        building them later is quicker.  With background=True this is done
+        in a daemon thread, which is returned.  Errors are ignored here;
+        they will be raised when the service is built.
+        """
+        factories = self.factory_names()
+        todo = set()
+        for name in (factories if names is None else names):
+            todo.update(factories.get(name, ()))
+        def run():
+            for factory in sorted(todo):
+                try:
+                    import_name(factory)
+                except Exception:
+                    log.debug("Failed to prefetch %s", factory, exc_info=True)
+        if not background:
+            run()
+            return None
+        thread = threading.Thread(target=run, name="pato-prefetch")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _build(self, name):
+        definition = self.definitions[name]
+        if isinstance(definition, dict) and definition.get(self.executor_key):
+            return self._host_service(name, definition)
+        return self._resolve_value(definition)
+
+    def _host_service(self, name, definition):
+        """
+        Return a proxy for a service which is built and run in worker
+        processes (see pato.process)
+        """
+        executor = self._resolve_value(definition[self.executor_key])
+        if executor == "process":
+            executor = self.get_process_host()
+        elif not callable(getattr(executor, "register", None)):
+            raise ValueError("Service %r: %s must be 'process' or a reference to a "
+                             "pato.process.ProcessHost, not %r" % (
+                                 name, self.executor_key, executor))
+        definitions = {}
+        for dep in self.requirements([name]):
+            value = self.definitions[dep]
+            if isinstance(value, dict) and self.executor_key in value:
+                # the workers build it themselves
+                value = dict((k, v) for (k, v) in six.iteritems(value) if k != self.executor_key)
+            definitions[dep] = value
+        return executor.register(name, pack_export(dict(
+            settings=self.settings(), definitions=definitions, plan=None)))
+
+    def get_process_host(self):
+        """
+        Return the ProcessHost for ':executor: process' services, which is
+        shared with child containers, and shut down by close() or when
+        this container is garbage collected
+        """
+        if self.host_owner is not None:
+            return self.host_owner.get_process_host()
+        with self.host_lock:
+            if self.process_host is None:
+                from pato.process import ProcessHost
+                self.process_host = ProcessHost()
+                self.host_finalizer = weakref.finalize(self, self.process_host.shutdown, False)
+            return self.process_host
+
+    def close(self):
+        """Shut down the worker processes of ':executor: process' services"""
+        with self.host_lock:
+            host, self.process_host = self.process_host, None
+            if self.host_finalizer is not None:
+                self.host_finalizer.detach()
+                self.host_finalizer = None
+        if host is not None:
+            host.shutdown()
+
+    def _derive(self, name, service, path):
+        """
+        Return an attribute path like '.pool.size' of a service.  The
+        value is remembered until the service itself is replaced, so that
+        building many dependents does not repeat the traversal (or call
+        expensive properties again).
+        """
+        paths = self.derived.setdefault(name, {})
+        entry = paths.get(path)
+        if entry is not None and entry[0] is service:
+            return entry[1]
+        value = six.moves.reduce(getattr, [a for a in path.split(".") if a], service)
+        paths[path] = (service, value)
+        return value
+
+    def _check_failure(self, name):
+        """Raise the remembered exception if the service failed recently"""
+        failure = self.failures.get(name)
+        if failure is not None and failure[0] > time.time():
+            err = failure[1]
+            raise copy_exception(err, err.args)
+
+    def _record_failure(self, name, err, message):
+        """
+        Remember a failure, so that lookups fail immediately instead of
+        trying again.  A timeout is remembered for retry_after seconds,
+        and other errors for failure_backoff seconds (if set); the time
+        doubles with each consecutive failure, up to max_backoff.
+        """
+        delay = self.retry_after if isinstance(err, BuildTimeout) else self.failure_backoff
+        if not delay:
+            return
+        count = self.failures[name][2] + 1 if name in self.failures else 1
+        delay = min(self.max_backoff, delay * 2 ** (count - 1))
+        self.failures[name] = (time.time() + delay,
+                               copy_exception(err, err.args + (message,)), count)
+
+    def _call_factory(self, value, factory, args, kwargs):
+        timeout = value.get(self.timeout_key, self.build_timeout)
+        if self.deadline is not None:
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                raise BuildTimeout("Build deadline of %.3g seconds exceeded" % self.build_timeout)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        if timeout is None:
+            return factory(*args, **kwargs)
+        return call_with_timeout(factory, args, kwargs, timeout)
+
     def _resolve_value(self, value):
         if isinstance(value, six.string_types):
             if value[0:2] == "<<":
@@ -174,8 +906,9 @@ class Container(object):
             if value[0:1] == "<" and ">" in value:
                 service_name, _, attrs = value[1:].rpartition(">")
                 service = self._resolve_service(service_name)
-                attrs = [a for a in attrs.split('.') if a]
-                return six.moves.reduce(getattr, attrs, service)
+                if not attrs.strip("."):
+                    return service
+                return self._derive(service_name, service, attrs)
 
         elif isinstance(value, dict):
             if self.factory_key in value:
@@ -186,10 +919,10 @@ class Container(object):
                     factory = import_name(factory)
                 kwargs = {}
                 for (dict_key, dict_value) in six.iteritems(value):
-                    if dict_key != self.factory_key:
+                    if dict_key != self.factory_key and dict_key != self.timeout_key:
                         kwargs[dict_key] = self._resolve_value(dict_value)
                 try:
-                    return factory(*args, **kwargs)
+                    return self._call_factory(value, factory, args, kwargs)
                 except Exception as err:
                     raise_and_annotate(err, "While calling factory '%s'" % value[self.factory_key])
             return {dict_key: self._resolve_value(dict_value)
@@ -199,3 +932,43 @@ class Container(object):
             return [self._resolve_value(item) for item in value]
 
         return value
+
+class Watcher(threading.Thread):
+    """
+    Polls the YAML files loaded into a container and reloads it when any
+    of them change.  A failed reload is logged, and retried when the files
+    change again.  on_reload, if given, is called with the set of service
+    names which were replaced.
+    """
+
+    def __init__(self, container, interval=2.0, on_reload=None):
+        super(Watcher, self).__init__(name="pato-watcher")
+        self.daemon = True
+        self.container = container
+        self.interval = interval
+        self.on_reload = on_reload
+        self.stopped = threading.Event()
+        self.failed = None      # file versions at the last failure
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def check(self):
+        versions = [file_version(s.filename) for s in self.container.sources if s.filename]
+        if versions == self.failed:
+            return
+        try:
+            replaced = self.container.reload()
+        except Exception:
+            self.failed = versions
+            log.exception("Failed to reload service definitions")
+            return
+        self.failed = None
+        if replaced:
+            log.info("Reloaded services: %s", ", ".join(sorted(replaced)))
+            if self.on_reload:
+                self.on_reload(replaced)
+
+    def stop(self):
+        self.stopped.set()
@@ -20,6 +20,36 @@ def local_factory():
 
 ctx = local_factory()
 
+class ContextLocal(object):
+    """
+    An object on which attributes can be set, which are distinct for each
+    asyncio task (or other contextvars.Context).  A task sees the values
+    set by the code which created it, but changes it makes are not seen
+    by its parent.  Requires python 3.7+
+    """
+    def __init__(self):
+        import contextvars
+        object.__setattr__(self, "_var", contextvars.ContextVar("pato.local.%x" % id(self)))
+
+    def __getattr__(self, name):
+        try:
+            return self._var.get({})[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        values = dict(self._var.get({}))
+        values[name] = value
+        self._var.set(values)
+
+    def __delattr__(self, name):
+        values = dict(self._var.get({}))
+        try:
+            del values[name]
+        except KeyError:
+            raise AttributeError(name)
+        self._var.set(values)
+
 def get_ctx():
     """
     A factory-like function which always returns the singleton ctx object
@@ -54,3 +84,15 @@ def setattrs(local=ctx, **overrides):
                 delattr(local, key)
             else:
                 setattr(local, key, prev[key])
+
+try:
+    actx = ContextLocal()
+except ImportError:     # python < 3.7
+    actx = None
+
+def get_actx():
+    """
+    Like get_ctx, but returns the singleton ContextLocal object for
+    asyncio code
+    """
+    return actx
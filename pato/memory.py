@@ -0,0 +1,146 @@
+"""
+Finding out how much memory the services in a container use (requires
+python 3.4+ for tracemalloc).
+
+    from pato.memory import MemoryTracker
+    c = Container()
+    tracker = MemoryTracker(c)
+    c.load_yaml_file("services.yaml")
+    c.resolve_all()
+    ...
+    for (name, info) in sorted(tracker.report().items(),
+                               key=lambda item: -item[1]["size"]):
+        print(name, info["size"], info["allocated"], info["retired_alive"])
+
+For each service built while the tracker is attached, this records the
+memory allocated (and not yet freed) while it was being built, using
+tracemalloc.  This includes any dependencies built at the same time, and
+comparing snapshots of the whole heap makes each build considerably
+slower, so it is a tool for diagnosis rather than for production.
+
+The report also estimates the size each service retains now, by walking
+the objects it refers to (up to max_objects of them).  Other services,
+classes, functions and modules are not counted, but any other object
+shared by several services is counted in each of them.
+
+When a service is replaced - by expire(), reload() or redefining it -
+the tracker keeps a weak reference to the old object, so that old
+objects which are still alive, because something still refers to them,
+show up as retired_alive.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import gc, sys, threading, tracemalloc, types, weakref
+
+SKIP = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+        types.CodeType, weakref.ref)
+
+def deep_size(obj, exclude=(), max_objects=100000):
+    """
+    Return (bytes, number of objects, complete) for obj and the objects
+    reachable from it, not counting those whose ids are in exclude, nor
+    classes, functions and modules.  complete is False if the walk
+    stopped after max_objects objects.
+    """
+    seen = set(exclude)
+    todo = [obj]
+    size = count = 0
+    while todo and count < max_objects:
+        item = todo.pop()
+        if id(item) in seen or isinstance(item, SKIP):
+            continue
+        seen.add(id(item))
+        count += 1
+        size += sys.getsizeof(item, 0)
+        todo.extend(gc.get_referents(item))
+    return size, count, not todo
+
+class MemoryTracker(object):
+    """
+    Records memory use for a Container; see module documentation.
+    tracemalloc is started if it is not already running.
+    """
+
+    def __init__(self, container, max_objects=100000):
+        self.started = not tracemalloc.is_tracing()
+        if self.started:
+            tracemalloc.start()
+        self.container = container
+        self.max_objects = max_objects
+        self.lock = threading.Lock()
+        self.allocations = {}   # {service name: [(bytes, count) for each build]}
+        self.retired = {}       # {service name: [weak reference to old object]}
+        self.filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        container.memory = self
+
+    def stop(self):
+        """Detach from the container, and stop tracemalloc if this started it"""
+        if self.container.memory is self:
+            self.container.memory = None
+        if self.started:
+            tracemalloc.stop()
+            self.started = False
+
+    def build(self, name, func, *args):
+        """Call func(*args) to build a service, recording what it allocates"""
+        gc.collect()    # so that freeing earlier garbage is not counted against it
+        before = tracemalloc.take_snapshot().filter_traces(self.filters)
+        try:
+            return func(*args)
+        finally:
+            after = tracemalloc.take_snapshot().filter_traces(self.filters)
+            diffs = after.compare_to(before, "filename")
+            with self.lock:
+                self.allocations.setdefault(name, []).append(
+                    (sum(d.size_diff for d in diffs), sum(d.count_diff for d in diffs)))
+
+    def retire(self, name, service):
+        """Called when a built service is dropped from the container"""
+        try:
+            ref = weakref.ref(service)
+        except TypeError:
+            return      # e.g. strings and dicts; these cannot leak in an interesting way
+        with self.lock:
+            self.retired.setdefault(name, []).append(ref)
+
+    def report(self):
+        """
+        Return {service name: dict} where the dict has:
+
+        size: approximate bytes retained by the current object (or None)
+        objects: number of objects counted in size
+        complete: False if the walk for size stopped at max_objects
+        allocated: net bytes allocated during the latest build
+        allocations: net number of memory blocks allocated
+        builds: number of times built while tracked
+        growth: allocated in the latest build less that in the first
+        retired_alive: number of replaced objects which are still alive
+        """
+        gc.collect()
+        services = dict(self.container.services)
+        exclude = set(id(s) for s in services.values())
+        exclude.add(id(self.container))
+        res = {}
+        with self.lock:
+            for (name, refs) in list(self.retired.items()):
+                alive = [ref for ref in refs if ref() is not None]
+                if alive:
+                    self.retired[name] = alive
+                else:
+                    del self.retired[name]
+            names = set(services) | set(self.allocations) | set(self.retired)
+            for name in names:
+                allocs = self.allocations.get(name, [])
+                info = res[name] = dict(
+                    size=None, objects=0, complete=True,
+                    allocated=allocs[-1][0] if allocs else None,
+                    allocations=allocs[-1][1] if allocs else None,
+                    builds=len(allocs),
+                    growth=allocs[-1][0] - allocs[0][0] if allocs else 0,
+                    retired_alive=len(self.retired.get(name, ())),
+                )
+                if name in services:
+                    service = services[name]
+                    (info["size"], info["objects"], info["complete"]) = deep_size(
+                        service, exclude - {id(service)}, self.max_objects)
+        return res
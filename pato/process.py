@@ -0,0 +1,187 @@
+"""
+Hosting container services in a pool of worker processes (requires
+python 3, or the 'futures' backport).
+
+A CPU-bound service, such as an XML transform or a report renderer,
+competes for the GIL with the threads handling requests.  Mark it with
+the :executor option and the container gives out a proxy instead; each
+method call on the proxy is sent (with pickled arguments) to a pool of
+worker processes, which build the service from the same definitions:
+
+    report/renderer:
+      :: myapp.reports.Renderer
+      :executor: process
+      templates: <report/templates>
+    report/templates: /srv/templates
+
+    html = c["report/renderer"].render("invoice", data)
+
+"process" uses a pool belonging to the container, with one worker per
+CPU.  For a different size, define a ProcessHost service and refer to it:
+
+    report/pool:
+      :: pato.process.ProcessHost
+      max_workers: 2
+    report/renderer:
+      :: myapp.reports.Renderer
+      :executor: <report/pool>
+
+Only the definitions of the service and the services it depends on are
+sent to the workers, and only to a worker which has not already built
+the service from them; they must be picklable, so a service object passed
+in directly (c["x"] = obj) has to be a module-level class or function.
+Arguments and return values must be picklable too.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+from concurrent.futures import ProcessPoolExecutor
+from pato.container import Container
+import hashlib, multiprocessing, threading, time
+
+timer = getattr(time, "perf_counter", time.time)
+
+hosted = {}     # in a worker process: {service name: (digest, service)}
+
+class NotHosted(Exception):
+    """
+    Raised by run_call when the worker has not built the service from the
+    current definitions, and they were not sent with the call
+    """
+
+def run_call(name, digest, method, args, kwargs, data=None):
+    """
+    Runs in a worker process: build the service if this worker has not
+    already done so (or its definitions have changed), then call it.
+    Returns the result and the time the call took.
+    """
+    entry = hosted.get(name)
+    if entry is None or entry[0] != digest:
+        if data is None:
+            raise NotHosted(name)
+        entry = hosted[name] = (digest, Container.from_export(data)[name])
+    func = entry[1] if method is None else getattr(entry[1], method)
+    start = timer()
+    res = func(*args, **kwargs)
+    return res, timer() - start
+
+class ServiceProxy(object):
+    """
+    Stands in for a service hosted in a ProcessHost.  Calling a method
+    runs it in a worker process and waits for the result; calling the
+    proxy itself calls the service.
+    """
+    __slots__ = ("_host", "_name")
+
+    def __init__(self, host, name):
+        self._host = host
+        self._name = name
+
+    def __getattr__(self, method):
+        if method.startswith("__"):
+            raise AttributeError(method)
+        def call(*args, **kwargs):
+            return self._host.call(self._name, method, args, kwargs)
+        call.__name__ = str(method)
+        return call
+
+    def __call__(self, *args, **kwargs):
+        return self._host.call(self._name, None, args, kwargs)
+
+    def __repr__(self):
+        return "<ServiceProxy %r>" % self._name
+
+class ProcessHost(object):
+    """
+    A pool of worker processes hosting services.  The pool is started on
+    the first call.  mp_context may be a multiprocessing start method such
+    as "spawn"; the default is the platform's.
+    """
+
+    def __init__(self, max_workers=None, mp_context=None):
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        self.mp_context = mp_context
+        self.executor = None
+        self.services = {}      # {service name: (digest, exported definitions)}
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.definitions_sent = 0
+        self.calls = {}         # {"service.method": [count, errors, total, run, max]}
+
+    def register(self, name, data):
+        """
+        Host a service and return a proxy for it.  data is a container
+        export (see Container.export) with the definitions needed to build
+        the service.
+        """
+        self.services[name] = (hashlib.sha1(data).hexdigest(), data)
+        return ServiceProxy(self, name)
+
+    def pool(self):
+        with self.lock:
+            if self.executor is None:
+                kwargs = {}
+                if self.mp_context:
+                    kwargs["mp_context"] = multiprocessing.get_context(self.mp_context)
+                self.executor = ProcessPoolExecutor(self.max_workers, **kwargs)
+            return self.executor
+
+    def call(self, name, method, args=(), kwargs=None):
+        """Call a method of a hosted service (or the service itself, if method is None)"""
+        (digest, data) = self.services[name]
+        key = name if method is None else "%s.%s" % (name, method)
+        with self.lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        start = timer()
+        ok = False
+        run = 0.0
+        try:
+            # Send just the digest, and the definitions only to a worker
+            # which does not have them yet
+            try:
+                (res, run) = self.pool().submit(
+                    run_call, name, digest, method, args, kwargs or {}).result()
+            except NotHosted:
+                with self.lock:
+                    self.definitions_sent += 1
+                (res, run) = self.pool().submit(
+                    run_call, name, digest, method, args, kwargs or {}, data).result()
+            ok = True
+            return res
+        finally:
+            elapsed = timer() - start
+            with self.lock:
+                self.in_flight -= 1
+                stats = self.calls.setdefault(key, [0, 0, 0.0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += not ok
+                stats[2] += elapsed
+                stats[3] += run
+                stats[4] = max(stats[4], elapsed)
+
+    def stats(self):
+        """
+        Return the pool size, the number of calls waiting or running
+        (queue_depth) and its peak, how many times service definitions
+        were sent to a worker, and for each "service.method" the
+        number of calls and errors, and the total time, time spent running
+        in the worker, and longest time for a call, in seconds
+        """
+        with self.lock:
+            return dict(
+                workers=self.max_workers,
+                started=self.executor is not None,
+                queue_depth=self.in_flight,
+                peak_queue_depth=self.peak_in_flight,
+                definitions_sent=self.definitions_sent,
+                calls=dict((key, dict(calls=s[0], errors=s[1], total_time=s[2],
+                                      run_time=s[3], max_time=s[4]))
+                           for (key, s) in self.calls.items()),
+            )
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait)
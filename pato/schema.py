@@ -0,0 +1,162 @@
+"""
+Typed decoding of parsed SOAP bodies.
+
+xmltodict leaves every value as a string, and gives a single dict or a
+list of dicts for an element depending on how many times it occurs.  A
+Schema is compiled from a small declarative spec, which maps body
+elements to types, and hooks into xmltodict so that values are converted
+in the same pass as parsing:
+
+    xyz:PlaceOrder:
+      customer: str
+      urgent: bool
+      "@version": int           # an attribute
+      lines:                    # always a list, even with one line
+        - sku: str
+          quantity: int
+          price: decimal
+      notes: [str]              # always a list of strings
+
+Types are str, int, float, decimal, bool and date; XSD names such as
+xsd:int, xs:double or xsd:boolean are also accepted.
+
+With records=True, each element described by a dict is returned as an
+object with __slots__ named after the child elements (without namespace
+prefix), e.g. body["xyz:PlaceOrder"].lines[0].quantity.  Missing
+elements are None, or an empty list if they are declared as lists.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+from datetime import datetime
+from decimal import Decimal
+import re, six
+
+def parse_bool(value):
+    value = value.strip()
+    if value in ("true", "1"):
+        return True
+    if value in ("false", "0"):
+        return False
+    raise ValueError("Invalid boolean '%s'" % value)
+
+def parse_date(value):
+    return datetime.strptime(value.strip()[0:10], "%Y-%m-%d").date()
+
+TYPES = {
+    "str": six.text_type,
+    "string": six.text_type,
+    "int": int,
+    "integer": int,
+    "long": int,
+    "short": int,
+    "float": float,
+    "double": float,
+    "decimal": Decimal,
+    "bool": parse_bool,
+    "boolean": parse_bool,
+    "date": parse_date,
+}
+
+class Record(object):
+    """Base class for the record objects built by Schema"""
+    __slots__ = ()
+    fields = ()     # [(attribute name, element key, is list)]
+
+    @classmethod
+    def from_dict(cls, data):
+        obj = cls.__new__(cls)
+        for (attr, key, is_list) in cls.fields:
+            value = data.get(key)
+            if value is None and is_list:
+                value = []
+            setattr(obj, attr, value)
+        return obj
+
+    def __eq__(self, other):
+        return type(self) is type(other) and \
+            all(getattr(self, attr) == getattr(other, attr) for attr in self.__slots__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join(
+            "%s=%r" % (attr, getattr(self, attr)) for attr in self.__slots__))
+
+def attribute_name(key):
+    """Turn an element or attribute name like 'xyz:Some-Thing' into 'Some_Thing'"""
+    return re.sub(r"\W", "_", key.lstrip("@#").rpartition(":")[2])
+
+class Schema(object):
+    """
+    A compiled spec (see module documentation).  Pass it to SOAPReceiver
+    as schema=..., or use its postprocessor and force_list methods as the
+    corresponding xmltodict.parse options.
+
+    The generated record classes cannot be pickled, so a schema with
+    records=True cannot be used with a process pool in AsyncSOAPReceiver.
+    """
+
+    def __init__(self, spec, records=False, body_names=("s11:Body", "s12:Body")):
+        self.records = records
+        self.body_names = body_names
+        self.converters = {}    # {path: function}
+        self.lists = set()      # {path}
+        self.classes = {}       # {path: Record subclass}
+        for (key, value) in six.iteritems(spec):
+            self.compile((key,), value)
+
+    def compile(self, path, spec):
+        if isinstance(spec, list):
+            if len(spec) != 1:
+                raise ValueError("List at '%s' must have a single element type" % "/".join(path))
+            self.lists.add(path)
+            spec = spec[0]
+        if isinstance(spec, dict):
+            for (key, value) in six.iteritems(spec):
+                self.compile(path + (key,), value)
+            if self.records:
+                fields = tuple((attribute_name(key), key, path + (key,) in self.lists)
+                               for key in spec)
+                self.classes[path] = type(str(attribute_name(path[-1])), (Record,), {
+                    "__slots__": tuple(f[0] for f in fields),
+                    "fields": fields,
+                })
+        else:
+            name = six.text_type(spec).rpartition(":")[2]
+            try:
+                self.converters[path] = TYPES[name]
+            except KeyError:
+                raise ValueError("Unknown type '%s' at '%s'" % (spec, "/".join(path)))
+
+    def body_path(self, path):
+        """
+        Return the element names in an xmltodict path relative to the
+        SOAP body, or None if the path is not inside the body
+        """
+        if len(path) < 2 or path[1][0] not in self.body_names:
+            return None
+        return tuple(p[0] for p in path[2:])
+
+    def postprocessor(self, path, key, value):
+        names = self.body_path(path)
+        if not names:
+            return key, value
+        if key[0:1] in ("@", "#"):
+            names += (key,)
+        convert = self.converters.get(names)
+        if convert is not None:
+            if isinstance(value, dict):
+                if "#text" in value:
+                    value["#text"] = convert(value["#text"])
+            elif value is not None:
+                value = convert(value)
+            return key, value
+        cls = self.classes.get(names)
+        if cls is not None and (value is None or isinstance(value, dict)):
+            value = cls.from_dict(value or {})
+        return key, value
+
+    def force_list(self, path, key, value):
+        names = self.body_path(path)
+        return names is not None and names + (key,) in self.lists
@@ -1,7 +1,10 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 from collections import OrderedDict  # for deterministic XML
 from contextlib import contextmanager
-import sys
+from pato.container import import_name
+from pato.local import ctx as default_local, setattrs, SENTINEL
+from pato.schema import Schema
+import random, six, sys, threading, time
 from traceback import format_exception_only, format_tb
 import xmltodict
 
@@ -11,6 +14,15 @@ SOAP12 = "http://www.w3.org/2003/05/soap-envelope"
 SOAP11_ENCODING_STYLE = "http://schemas.xmlsoap.org/soap/encoding/"
 SOAP12_ENCODING_STYLE = "http://www.w3.org/2003/05/soap-encoding"
 
+ENVELOPES = {"s11:Envelope": SOAP11, "s12:Envelope": SOAP12}
+
+FAULT_CODES = {
+    SOAP11: {"Server": "env:Server", "Client": "env:Client"},
+    SOAP12: {"Server": "env:Receiver", "Client": "env:Sender"},
+}
+
+timer = getattr(time, "perf_counter", time.time)
+
 class SOAPReceiver(object):
     """
     Takes a text body, invokes the wrapped app function. It passes a
@@ -23,7 +35,12 @@ class SOAPReceiver(object):
     response.
 
     An exception is converted into a SOAP fault, unless you set
-    trap_exception=False.
+    trap_exception=False.  By default the fault includes the full
+    traceback; pass a FaultPolicy to change this.
+
+    If schema is given (a pato.schema.Schema, or a spec dict to compile
+    into one) then values in the body are converted to the declared
+    types as they are parsed.
     """
 
     NAMESPACES = OrderedDict([
@@ -33,7 +50,8 @@ class SOAPReceiver(object):
 
     def __init__(self, app, namespaces=None, reply_attrs=None,
                  unparse_options=dict(pretty=True, full_document=False, indent="  "),
-                 encoding_style=None, trap_exception=True, ctx=None):
+                 encoding_style=None, trap_exception=True, ctx=None, fault_policy=None,
+                 schema=None):
         self.app = app
         self.namespaces = namespaces
         self.reply_attrs = reply_attrs
@@ -41,52 +59,32 @@ class SOAPReceiver(object):
         self.encoding_style = encoding_style
         self.trap_exception = trap_exception
         self.ctx = ctx
+        self.fault_policy = fault_policy
         if namespaces:
             self.parse_ns = self.NAMESPACES.copy()
             self.parse_ns.update(namespaces)
         else:
             self.parse_ns = self.NAMESPACES
+        self.parse_options = dict(process_namespaces=True, namespaces=self.parse_ns)
+        if schema is not None:
+            if isinstance(schema, dict):
+                schema = Schema(schema)
+            self.parse_options.update(postprocessor=schema.postprocessor,
+                                      force_list=schema.force_list)
+        self.schema = schema
 
     def __call__(self, text):
         soap_version = None
         try:
-            data = xmltodict.parse(text, process_namespaces=True,
-                                   namespaces=self.parse_ns)
-            if "s11:Envelope" in data:
-                soap_version = SOAP11
-                body = data["s11:Envelope"]["s11:Body"]
-            elif "s12:Envelope" in data:
-                soap_version = SOAP12
-                body = data["s12:Envelope"]["s12:Body"]
-            else:
+            soap_version, body = self.parse(text)
+            if soap_version is None:
                 if self.ctx:
                     self.ctx.exc_info = None
                     self.ctx.error = True
                 return "Missing SOAP Envelope"
-            res = self.app(body)
-            out = OrderedDict([
-                ("env:Envelope", OrderedDict([
-                    ("@xmlns:env", soap_version),
-                    ("env:Body", res),
-                ])),
-            ])
-            # Add namespace attributes, preferably to the inner top-level element
-            # but fallback to putting them on the Envelope
-            root = out["env:Envelope"]
-            try:
-                keys = res.keys()
-                if len(keys) == 1:
-                    root = res[keys[0]]
-            except AttributeError:
-                pass
-            for (k, v) in self.namespaces.iteritems():
-                root["@xmlns:"+v] = k
-            # Add canned attributes, typically for adding encodingStyle
-            # (Note: SOAP 1.1 allows this to be anywhere including on the
-            # envelope, but SOAP 1.2 is more restrictive)
-            if self.reply_attrs:
-                root.update(self.reply_attrs)
-            return xmltodict.unparse(out, **self.unparse_options)
+            res = self.invoke(body, soap_version)
+            return xmltodict.unparse(self.envelope(res, soap_version),
+                                     **self.unparse_options)
 
         except Exception:
             if not self.trap_exception: raise
@@ -96,39 +94,435 @@ class SOAPReceiver(object):
                 # and for a HTTP connector to return a 500 status code
                 self.ctx.exc_info = exc_info
                 self.ctx.error = True
-            return xmltodict.unparse(self.fault(exc_info, soap_version),
-                                     **self.unparse_options)
+            return self.render_fault(exc_info, soap_version)
+
+    def parse(self, text):
+        """Parse the XML text and return (soap_version, body); see unwrap"""
+        return self.unwrap(xmltodict.parse(text, **self.parse_options))
+
+    def unwrap(self, data):
+        """
+        Given the parsed XML, return (soap_version, body) or (None, None)
+        if there is no SOAP envelope
+        """
+        if "s11:Envelope" in data:
+            return SOAP11, data["s11:Envelope"]["s11:Body"]
+        elif "s12:Envelope" in data:
+            return SOAP12, data["s12:Envelope"]["s12:Body"]
+        return None, None
+
+    def invoke(self, body, soap_version=None):
+        """
+        Process the SOAP body and return the response body
+        """
+        return self.app(body)
+
+    def envelope(self, res, soap_version):
+        """
+        Wrap the response body in a SOAP envelope, ready for unparsing
+        """
+        out = OrderedDict([
+            ("env:Envelope", OrderedDict([
+                ("@xmlns:env", soap_version),
+                ("env:Body", res),
+            ])),
+        ])
+        # Add namespace attributes, preferably to the inner top-level element
+        # but fallback to putting them on the Envelope
+        root = out["env:Envelope"]
+        try:
+            keys = list(res.keys())
+            if len(keys) == 1 and isinstance(res[keys[0]], dict):
+                root = res[keys[0]]
+        except AttributeError:
+            pass
+        for (k, v) in six.iteritems(self.namespaces or {}):
+            root["@xmlns:"+v] = k
+        # Add canned attributes, typically for adding encodingStyle
+        # (Note: SOAP 1.1 allows this to be anywhere including on the
+        # envelope, but SOAP 1.2 is more restrictive)
+        if self.reply_attrs:
+            root.update(self.reply_attrs)
+        return out
+
+    def render_fault(self, exc_info, soap_version=None):
+        """Return the serialised SOAP fault for an exception"""
+        if self.fault_policy:
+            return self.fault_policy.render(self, exc_info, soap_version)
+        return xmltodict.unparse(self.fault(exc_info, soap_version),
+                                 **self.unparse_options)
 
-    def fault(self, exc_info, soap_version=None):
-        reason = "".join(format_exception_only(*exc_info[0:2])).strip()
-        detail = "".join(format_tb(*exc_info[2:])).strip()
+    def fault(self, exc_info, soap_version=None, code="Server", reason=None, detail=True):
+        """
+        Build a SOAP fault.  code is "Server" or "Client"; reason defaults
+        to the exception message; detail is a string, True for the
+        formatted traceback, or False to leave it out.
+        """
+        if reason is None:
+            reason = "".join(format_exception_only(*exc_info[0:2])).strip()
+        if detail is True:
+            detail = "".join(format_tb(*exc_info[2:])).strip()
+        code = FAULT_CODES[soap_version or SOAP11][code]
         if soap_version == SOAP12:
             # https://www.w3.org/TR/2007/REC-soap12-part0-20070427/#L11549
             res = OrderedDict([
                 ("env:Fault", OrderedDict([
                     ("env:Code", OrderedDict([
-                        ("env:Value", "env:Receiver"),
+                        ("env:Value", code),
                     ])),
                     ("env:Reason", OrderedDict([
                         ("env:Text", reason),
                     ])),
-                    ("env:Detail", OrderedDict([
-                        ("env:Text", detail),
-                    ])),
                 ])),
             ])
+            if detail:
+                res["env:Fault"]["env:Detail"] = OrderedDict([
+                    ("env:Text", detail),
+                ])
         else:
             # https://www.w3.org/TR/2000/NOTE-SOAP-20000508/
             res = OrderedDict([
                 ("env:Fault", OrderedDict([
-                    ("faultcode", "env:Server"),
+                    ("faultcode", code),
                     ("faultstring", reason),
-                    ("detail", detail),
                 ])),
             ])
+            if detail:
+                res["env:Fault"]["detail"] = detail
         return OrderedDict([
             ("env:Envelope", OrderedDict([
                 ("@xmlns:env", soap_version or SOAP11),
                 ("env:Body", res),
             ])),
         ])
+
+class FaultPolicy(object):
+    """
+    Controls the cost and content of SOAP faults, which matters when a
+    downstream outage makes every request fail.
+
+    faults maps exception classes (or their dotted names) to a
+    (code, reason) pair, where code is "Server" or "Client" and reason
+    is a fixed string, or None to use the exception message.  The
+    most specific class matching the exception is used; anything
+    unmatched is a "Server" fault with the exception message.
+
+    A traceback is only included in the detail for a fraction
+    traceback_rate of faults (default none), and for at most
+    max_tracebacks faults per period seconds.  Faults without a
+    traceback are cached in serialised form (up to cache_size of them),
+    so a storm of identical faults costs a dict lookup each.
+
+    soap/fault_policy:
+      :: pato.soap.FaultPolicy
+      faults:
+        myapp.errors.NotFound: [Client, "No such record"]
+        sqlalchemy.exc.OperationalError: [Server, "Database unavailable"]
+      traceback_rate: 0.01
+      max_tracebacks: 10
+    """
+
+    def __init__(self, faults=None, traceback_rate=0.0, max_tracebacks=None,
+                 period=1.0, cache_size=256):
+        self.faults = {}
+        for (exc_class, (code, reason)) in six.iteritems(faults or {}):
+            if isinstance(exc_class, six.string_types):
+                exc_class = import_name(exc_class)
+            self.faults[exc_class] = (code, reason)
+        self.traceback_rate = traceback_rate
+        self.max_tracebacks = max_tracebacks
+        self.period = period
+        self.cache_size = cache_size
+        self.classified = {}    # {exception class: (code, reason)}
+        self.cache = OrderedDict()   # {(receiver, soap_version, code, reason): text}
+        self.window_start = 0
+        self.window_count = 0
+        self.lock = threading.Lock()
+
+    def classify(self, exc_class):
+        """Return (code, reason) for an exception class"""
+        try:
+            return self.classified[exc_class]
+        except KeyError:
+            pass
+        res = ("Server", None)
+        for cls in getattr(exc_class, "__mro__", ()):
+            if cls in self.faults:
+                res = self.faults[cls]
+                break
+        self.classified[exc_class] = res
+        return res
+
+    def want_traceback(self):
+        if not self.traceback_rate or random.random() >= self.traceback_rate:
+            return False
+        if self.max_tracebacks is None:
+            return True
+        with self.lock:
+            now = time.time()
+            if now - self.window_start >= self.period:
+                self.window_start = now
+                self.window_count = 0
+            if self.window_count >= self.max_tracebacks:
+                return False
+            self.window_count += 1
+            return True
+
+    def render(self, receiver, exc_info, soap_version=None):
+        code, reason = self.classify(exc_info[0])
+        if reason is None:
+            reason = "".join(format_exception_only(*exc_info[0:2])).strip()
+        if self.want_traceback():
+            return xmltodict.unparse(receiver.fault(exc_info, soap_version, code, reason, True),
+                                     **receiver.unparse_options)
+        # the text also depends on the receiver's fault() and unparse
+        # options, and the policy may be shared by several receivers
+        key = (receiver, soap_version, code, reason)
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        text = xmltodict.unparse(receiver.fault(exc_info, soap_version, code, reason, False),
+                                 **receiver.unparse_options)
+        with self.lock:
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+            self.cache[key] = text
+        return text
+
+class BatchSOAPReceiver(SOAPReceiver):
+    """
+    A SOAPReceiver for envelopes whose Body contains many independent
+    operations.  Each element of the body (and each repeat of a repeated
+    element) is passed to the app separately, as a body dict containing
+    just that element, and the calls run concurrently in a thread pool.
+
+    Each response is wrapped in an item_element (default "Result") with
+    index and operation attributes, one per operation in document
+    order.  If a call raises an exception then that item contains an
+    Error element (Code, Reason and optionally Detail) instead of the
+    response, and ctx.exc_info is set from the first failure.  A SOAP
+    env:Fault is not used here, since it must be the only child of the
+    Body.
+
+        <Result index="0" operation="m:GetLastTradePrice">
+          <m:GetLastTradePriceResponse>...</m:GetLastTradePriceResponse>
+        </Result>
+        <Result index="1" operation="m:GetLastTradePrice">
+          <Error><Code>Server</Code><Reason>RuntimeError: ...</Reason></Error>
+        </Result>
+
+    Each call runs inside setattrs(local, soap_operation=NAME,
+    soap_index=N), where local defaults to pato.local.ctx.  Because the
+    calls run in other threads, they do not see the caller's thread-local
+    attributes, except for those named in inherit.
+    """
+
+    def __init__(self, app, executor=None, max_workers=4, local=None, inherit=(),
+                 item_element="Result", **kwargs):
+        super(BatchSOAPReceiver, self).__init__(app, **kwargs)
+        self.item_element = item_element
+        self.executor = executor
+        self.max_workers = max_workers
+        self.local = default_local if local is None else local
+        self.inherit = inherit
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    from concurrent.futures import ThreadPoolExecutor
+                    self.executor = ThreadPoolExecutor(self.max_workers)
+        return self.executor
+
+    def parse(self, text):
+        """
+        Return (soap_version, list of (name, value)) with the elements of
+        the body in document order.  (A parsed dict would group repeated
+        elements together, at the position of the first one.)
+        """
+        found = []
+        items = []
+        def collect(path, item):
+            found.append(path[0][0])
+            if path[1][0] in ("s11:Body", "s12:Body"):
+                items.append((path[2][0], item))
+            return True
+        xmltodict.parse(text, item_depth=3, item_callback=collect, **self.parse_options)
+        if not found:   # nothing in the Header or Body
+            return super(BatchSOAPReceiver, self).parse(text)
+        return ENVELOPES.get(found[0]), items
+
+    def split(self, body):
+        """
+        Return a list of (name, value) for each operation in the body,
+        which is a list of them already (from parse) or a parsed dict
+        """
+        if isinstance(body, list):
+            return body
+        items = []
+        for (key, value) in six.iteritems(body or {}):
+            if key[0:1] in ("@", "#"):
+                continue
+            if isinstance(value, list):
+                items.extend((key, v) for v in value)
+            else:
+                items.append((key, value))
+        return items
+
+    def run_item(self, name, value, index, attrs):
+        attrs = dict(attrs, soap_operation=name, soap_index=index)
+        with setattrs(self.local, **attrs):
+            try:
+                return self.app(OrderedDict([(name, value)])), None
+            except Exception:
+                exc_info = sys.exc_info()
+                return self.item_error(exc_info), exc_info
+
+    def item_error(self, exc_info):
+        """Return the body of an Error element, for a single failed item"""
+        code, reason, detail = "Server", None, True
+        if self.fault_policy:
+            code, reason = self.fault_policy.classify(exc_info[0])
+            detail = self.fault_policy.want_traceback()
+        if reason is None:
+            reason = "".join(format_exception_only(*exc_info[0:2])).strip()
+        res = OrderedDict([("Code", code), ("Reason", reason)])
+        if detail:
+            res["Detail"] = "".join(format_tb(*exc_info[2:])).strip()
+        return OrderedDict([("Error", res)])
+
+    def invoke(self, body, soap_version=None):
+        attrs = {}
+        for key in self.inherit:
+            value = getattr(self.local, key, SENTINEL)
+            if value is not SENTINEL:
+                attrs[key] = value
+        executor = self.get_executor()
+        items = self.split(body)
+        futures = [executor.submit(self.run_item, name, value, index, attrs)
+                   for (index, (name, value)) in enumerate(items)]
+        results = []
+        first_error = None
+        for (index, future) in enumerate(futures):
+            res, exc_info = future.result()
+            if exc_info and not first_error:
+                first_error = exc_info
+            item = OrderedDict([("@index", str(index)), ("@operation", items[index][0])])
+            if isinstance(res, dict):
+                item.update(res)
+            elif res is not None:
+                item["#text"] = res
+            results.append(item)
+        if first_error and self.ctx:
+            self.ctx.exc_info = first_error
+            self.ctx.error = True
+        return OrderedDict([(self.item_element, results)]) if results else OrderedDict()
+
+class OperationStats(object):
+    """
+    Call counters and latency (in seconds) for a single SOAP operation
+    """
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, elapsed, error=False):
+        self.calls += 1
+        if error:
+            self.errors += 1
+        self.total_time += elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+
+    @property
+    def mean_time(self):
+        return self.total_time / self.calls if self.calls else 0.0
+
+    def as_dict(self):
+        return dict(calls=self.calls, errors=self.errors, total_time=self.total_time,
+                    mean_time=self.mean_time, max_time=self.max_time)
+
+class SOAPDispatcher(SOAPReceiver):
+    """
+    A SOAPReceiver which selects the app to invoke based on the name of
+    the first element inside the SOAP body, instead of passing every
+    request to a single app.
+
+    The operation names are qualified using the prefixes from
+    `namespaces`, and map to service names in a pato container.  Each
+    handler is looked up from the container the first time its operation
+    is called, and then cached; it is called in the same way as a
+    SOAPReceiver app, i.e. with the whole body dict.
+
+    soap/receiver:
+      :: pato.soap.SOAPDispatcher
+      container: <pato/container>
+      namespaces:
+        Some-URI: xyz
+      operations:
+        xyz:GetLastTradePrice: stock/price
+        xyz:GetCompanyName: stock/company
+
+    Call counts, error counts and latency for each operation are
+    available from stats().
+    """
+
+    def __init__(self, container, operations, **kwargs):
+        super(SOAPDispatcher, self).__init__(self.dispatch, **kwargs)
+        self.container = container
+        self.operations = operations
+        self.handlers = {}       # {operation: handler}
+        self.counters = {}       # {operation: OperationStats}
+        self.lock = threading.Lock()
+
+    def operation(self, body):
+        """Return the qualified name of the first element in the body"""
+        for key in (body or ()):
+            if key[0:1] not in ("@", "#"):
+                return key
+        raise ValueError("Empty SOAP Body")
+
+    def handler(self, operation):
+        """Return the (cached) handler for the given operation"""
+        try:
+            return self.handlers[operation]
+        except KeyError:
+            pass
+        if operation not in self.operations:
+            raise ValueError("Unknown SOAP operation '%s'" % operation)
+        self.handlers[operation] = handler = self.container[self.operations[operation]]
+        return handler
+
+    def dispatch(self, body):
+        operation = self.operation(body)
+        handler = self.handler(operation)
+        start = timer()
+        error = True
+        try:
+            res = handler(body)
+            error = False
+            return res
+        finally:
+            elapsed = timer() - start
+            with self.lock:
+                try:
+                    counter = self.counters[operation]
+                except KeyError:
+                    self.counters[operation] = counter = OperationStats()
+                counter.record(elapsed, error)
+
+    def expire(self):
+        """
+        Forget cached handlers, e.g. after the container has been reloaded
+        """
+        self.handlers.clear()
+
+    def stats(self):
+        """Return {operation: {calls, errors, total_time, mean_time, max_time}}"""
+        with self.lock:
+            return {operation: counter.as_dict()
+                    for (operation, counter) in six.iteritems(self.counters)}
@@ -3,18 +3,179 @@ Utilities for using pato with SQLAlchemy
 """
 
 from __future__ import absolute_import, division, print_function, unicode_literals
+from collections import OrderedDict
 from contextlib import contextmanager
+from itertools import islice
 from pato.local import get_ctx
-from sqlalchemy import event, create_engine as real_create_engine
+from sqlalchemy import event, text, create_engine as real_create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import sessionmaker
+import heapq, logging, os, random, re, shutil, six, sys, threading, time
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
 
 SENTINEL = object()
 
+log = logging.getLogger(__name__)
+timer = getattr(time, "perf_counter", time.time)
+
+class PoolStats(object):
+    """
+    Connection pool statistics for an engine, updated by pool event
+    listeners.  create_engine installs one of these as engine.pool_stats;
+    you can also define it as a service so it can be published:
+
+    db/pool_stats:
+      :: pato.sqla.PoolStats
+      slow_checkout: 0.5
+    db/engine:
+      :: [pato.sqla.create_engine, "postgresql://..."]
+      pool_size: 10
+      pool_stats: <db/pool_stats>
+
+    "wait" is the time taken by pool.connect() to provide a connection
+    (including opening a new one), and "held" the time from checkout to
+    checkin.  A checkout which waits longer than slow_checkout seconds
+    is logged as a warning.  All times are in seconds.
+    """
+
+    def __init__(self, slow_checkout=1.0):
+        self.slow_checkout = slow_checkout
+        self.lock = threading.Lock()
+        self.engine = None
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.held_total = 0.0
+        self.held_max = 0.0
+        self.slow_checkouts = 0
+        self.invalidations = 0
+
+    def install(self, engine):
+        """
+        Attach event listeners to the engine's pool.  The listeners carry
+        over to the new pool made by engine.dispose(), and the new pool's
+        connect() is timed too, so the statistics continue after a dispose.
+        """
+        self.engine = engine
+        event.listen(engine, "connect", self.on_connect)
+        event.listen(engine, "checkout", self.on_checkout)
+        event.listen(engine, "checkin", self.on_checkin)
+        event.listen(engine, "invalidate", self.on_invalidate)
+        event.listen(engine, "engine_disposed", lambda engine: self.time_connect(engine.pool))
+        self.time_connect(engine.pool)
+
+    def time_connect(self, pool):
+        """
+        Wrap pool.connect() to time it.  Wrapping the pool rather than the
+        engine means that engines made by engine.execution_options(),
+        which share the pool, are timed as well.
+        """
+        connect = pool.connect
+        def timed_connect():
+            start = timer()
+            try:
+                return connect()
+            finally:
+                self.record_wait(timer() - start)
+        pool.connect = timed_connect
+
+    @property
+    def pool(self):
+        return self.engine.pool if self.engine is not None else None
+
+    def record_wait(self, elapsed):
+        with self.lock:
+            self.wait_total += elapsed
+            self.wait_max = max(self.wait_max, elapsed)
+            if elapsed >= self.slow_checkout:
+                self.slow_checkouts += 1
+                slow = True
+            else:
+                slow = False
+        if slow:
+            log.warning("Slow connection checkout: waited %.3fs (%s)", elapsed, self.status())
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.connects += 1
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["pato_checkout_time"] = timer()
+        with self.lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        start = connection_record.info.pop("pato_checkout_time", None)
+        if start is None:
+            return
+        elapsed = timer() - start
+        with self.lock:
+            self.checkins += 1
+            self.in_use -= 1
+            self.held_total += elapsed
+            self.held_max = max(self.held_max, elapsed)
+
+    def on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self.lock:
+            self.invalidations += 1
+
+    def status(self):
+        """The pool's own description, e.g. its size and overflow"""
+        return self.pool.status() if self.pool is not None else "no pool"
+
+    def snapshot(self):
+        """Return the current statistics as a dict"""
+        with self.lock:
+            res = dict(
+                connects=self.connects,
+                checkouts=self.checkouts,
+                in_use=self.in_use,
+                peak_in_use=self.peak_in_use,
+                wait_total=self.wait_total,
+                wait_max=self.wait_max,
+                wait_mean=self.wait_total / self.checkouts if self.checkouts else 0.0,
+                held_total=self.held_total,
+                held_max=self.held_max,
+                held_mean=self.held_total / self.checkins if self.checkins else 0.0,
+                slow_checkouts=self.slow_checkouts,
+                invalidations=self.invalidations,
+            )
+        pool = self.pool
+        for attr in ("size", "overflow", "checkedin", "checkedout"):
+            method = getattr(pool, attr, None)
+            if method is not None:
+                res["pool_" + attr] = method()
+        return res
+
 def create_engine(*args, **kwargs):
     """
-    Create an engine including workarounds for specific backends
+    Create an engine including workarounds for specific backends,
+    and record pool statistics in engine.pool_stats (see PoolStats).
+    Pass pool_stats=<PoolStats object> to use your own, or
+    pool_stats=False to disable them.
     """
+    pool_stats = kwargs.pop("pool_stats", None)
     engine = real_create_engine(*args, **kwargs)
+    configure_engine(engine, pool_stats)
+    return engine
+
+def configure_engine(engine, pool_stats=None):
+    """
+    Install the pool statistics and backend workarounds on a (sync) engine
+    """
+    if pool_stats is not False:
+        engine.pool_stats = pool_stats or PoolStats()
+        engine.pool_stats.install(engine)
 
     if engine.name == "sqlite":
         # http://docs.sqlalchemy.org/en/rel_1_0/dialects/sqlite.html#pysqlite-serializable
@@ -26,20 +187,203 @@ def create_engine(*args, **kwargs):
 
         @event.listens_for(engine, "begin")
         def do_begin(conn):
-            # emit our own BEGIN
-            conn.execute("BEGIN")
+            # emit our own BEGIN (exec_driver_sql is needed for "future"
+            # and asyncio engines, which do not accept plain strings)
+            getattr(conn, "exec_driver_sql", conn.execute)("BEGIN")
 
-    return engine
+class LazySession(object):
+    """
+    A stand-in for a session, which creates the real session (and so
+    checks out a connection) only when it is first used.  Getting, setting
+    and deleting attributes (except those starting with "_"), "in",
+    iteration and "with" are passed through to the real session.
+    """
+    def __init__(self, factory, options=None):
+        self._factory = factory
+        self._options = options or {}
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = self._factory(**self._options)
+        return self._session
+
+    def __getattr__(self, name):
+        return getattr(self._get_session(), name)
+
+    def __setattr__(self, name, value):
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._get_session(), name, value)
+
+    def __delattr__(self, name):
+        if name.startswith("_"):
+            object.__delattr__(self, name)
+        else:
+            delattr(self._get_session(), name)
+
+    def __contains__(self, obj):
+        return obj in self._get_session()
+
+    def __iter__(self):
+        return iter(self._get_session())
+
+    def __enter__(self):
+        return self._get_session().__enter__()
+
+    def __exit__(self, *exc_info):
+        return self._get_session().__exit__(*exc_info)
+
+def real_session(session):
+    """Return the session behind a LazySession, or None if it was never used"""
+    if isinstance(session, LazySession):
+        return session._session
+    return session
+
+class RetryPolicy(object):
+    """
+    Decides whether a unit of work which failed with a transient database
+    error - a deadlock, lock timeout or serialization failure - should be
+    run again.  Give it to a SessionManager and invoke() will retry:
+
+    db/retry:
+      :: pato.sqla.RetryPolicy
+      max_attempts: 5
+      base_delay: 0.02
+      max_delay: 1
+      budget: 0.1
+    db/manager:
+      :: pato.sqla.SessionManager
+      engine: <db/engine>
+      retry: <db/retry>
+
+    Before attempt n+1 it sleeps for a random time between 0 and
+    base_delay * 2**(n-1), capped at max_delay, so that competing
+    transactions do not collide again in lockstep.
+
+    The retry budget stops retries from multiplying the load on an
+    overloaded database: each call earns "budget" retry tokens (up to
+    min_retries banked, which is also the starting balance) and each
+    retry spends one, so sustained retries are limited to that fraction
+    of calls.
+
+    The counters in stats() are calls, attempts, retries, recovered
+    (calls which succeeded after retrying), exhausted (calls which failed
+    after max_attempts) and budget_denied.
+
+    A lost connection is only retried if retry_disconnects is True.  If
+    it was lost during or after COMMIT, the transaction may have been
+    committed, and running the unit of work again would repeat it.
+    """
+
+    SQLSTATES = frozenset(["40001", "40P01", "55P03"])  # serialization, deadlock, lock not available
+    MYSQL_ERRORS = frozenset([1205, 1213])              # lock wait timeout, deadlock
+    SQLITE_MESSAGES = ("database is locked", "database table is locked")
+
+    def __init__(self, max_attempts=3, base_delay=0.02, max_delay=1.0, budget=0.1,
+                 min_retries=10, sleep=time.sleep, retry_disconnects=False):
+        self.max_attempts = max_attempts
+        self.retry_disconnects = retry_disconnects
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.min_retries = min_retries
+        self.tokens = float(min_retries)
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.counters = dict(calls=0, attempts=0, retries=0, recovered=0,
+                             exhausted=0, budget_denied=0)
+
+    def is_transient(self, err):
+        """
+        Return True if err (normally a sqlalchemy DBAPIError) is worth
+        retrying.  The driver's exception is checked for a Postgres
+        SQLSTATE, a MySQL error number or a SQLite lock message; and with
+        retry_disconnects, a disconnect is retried too.
+        """
+        if not isinstance(err, DBAPIError):
+            return False
+        if err.connection_invalidated:
+            return self.retry_disconnects
+        orig = err.orig
+        code = getattr(orig, "pgcode", None) or getattr(orig, "sqlstate", None)
+        if code in self.SQLSTATES:
+            return True
+        args = getattr(orig, "args", ())
+        if args and args[0] in self.MYSQL_ERRORS:
+            return True
+        message = six.text_type(orig).lower()
+        return any(m in message for m in self.SQLITE_MESSAGES)
+
+    def delay(self, attempt):
+        """The time to sleep after the given (1-based) failed attempt"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def allow_retry(self):
+        with self.lock:
+            if self.tokens < 1:
+                self.counters["budget_denied"] += 1
+                return False
+            self.tokens -= 1
+            self.counters["retries"] += 1
+            return True
+
+    def call(self, func, *args, **kwargs):
+        """Call func until it succeeds, or fails in a way not worth retrying"""
+        with self.lock:
+            self.counters["calls"] += 1
+            self.tokens = min(self.min_retries, self.tokens + self.budget)
+        attempt = 0
+        while True:
+            attempt += 1
+            self.count("attempts")
+            try:
+                res = func(*args, **kwargs)
+            except Exception as err:
+                if not self.is_transient(err):
+                    raise
+                if attempt >= self.max_attempts:
+                    self.count("exhausted")
+                    raise
+                if not self.allow_retry():
+                    raise
+                log.info("Retrying after transient database error (attempt %d): %s", attempt, err)
+                self.sleep(self.delay(attempt))
+                continue
+            if attempt > 1:
+                self.count("recovered")
+            return res
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
 
 class SessionManager(object):
-    def __init__(self, engine, session_factory=None, ctx_factory=get_ctx, attribute_name="db"):
+    """
+    See __call__.  If lazy is True, the session put in ctx is a
+    LazySession, so that scopes which never touch the database do not
+    check out a connection, commit or roll back.  If tracker is a
+    StatementTracker, the SQL statements executed in each scope are
+    summarised at the end of it.  If retry is a RetryPolicy, invoke()
+    retries on transient database errors.
+    """
+    def __init__(self, engine, session_factory=None, ctx_factory=get_ctx, attribute_name="db",
+                 lazy=False, tracker=None, retry=None):
         self.engine = engine
         self.session_factory = session_factory or sessionmaker(bind=engine)
         self.ctx_factory = ctx_factory
         self.attribute_name = attribute_name
+        self.lazy = lazy
+        self.tracker = tracker
+        self.retry = retry
 
     @contextmanager
-    def __call__(self, ctx=None, force_new=False):
+    def __call__(self, ctx=None, force_new=False, **options):
         """
         A context manager which creates a database session. Afterwards it
         either commits or rolls back the session and closes it. The session
@@ -58,22 +402,53 @@ class SessionManager(object):
         if not ctx: ctx = self.ctx_factory()
         old_session = getattr(ctx, self.attribute_name, SENTINEL)
         if old_session is not SENTINEL and old_session is not None and not force_new:
+            self.check_reuse(old_session, **options)
             yield old_session
         else:
-            session = self.session_factory()
+            tracking = self.tracker and self.tracker.start(ctx)
+            if self.lazy:
+                session = LazySession(self.create_session, options)
+            else:
+                session = self.create_session(**options)
             setattr(ctx, self.attribute_name, session)
             try:
                 yield session
-                session.commit()
-            except:
-                session.rollback()
+                active = real_session(session)
+                if active is not None:
+                    self.commit(active)
+            except BaseException as err:
+                active = real_session(session)
+                if active is not None:
+                    self.rollback(active, err)
                 raise
             finally:
-                session.close()
+                active = real_session(session)
+                if active is not None:
+                    active.close()
                 if old_session is SENTINEL:
                     delattr(ctx, self.attribute_name)
                 else:
                     setattr(ctx, self.attribute_name, old_session)
+                if tracking:
+                    self.tracker.finish(ctx)
+
+    def create_session(self, **options):
+        """
+        Create a new session.  options are those passed to __call__, such
+        as readonly; this class ignores them, so that code written for a
+        RoutingSessionManager also works with a plain one.
+        """
+        return self.session_factory()
+
+    def check_reuse(self, session, **options):
+        """Called when an existing session from ctx is about to be reused"""
+        pass
+
+    def commit(self, session):
+        session.commit()
+
+    def rollback(self, session, err):
+        session.rollback()
 
     def invoke(self, service, *args, **kwargs):
         """
@@ -83,10 +458,563 @@ class SessionManager(object):
         sessionmgr = SessionManager(engine)
         ...
         sessionmgr.invoke(myservice, arg1, arg2)
+
+        With a retry policy, the service is run again in a new session if
+        it fails with a transient error, so it must not have side-effects
+        outside the database.  This only happens in the outermost scope;
+        if ctx already has a session then a retry could not undo the rest
+        of the enclosing transaction, so the error is raised as usual.
         """
-        with self():
+        ctx = self.ctx_factory()
+        if self.retry is None or getattr(ctx, self.attribute_name, None) is not None:
+            with self(ctx):
+                return service(*args, **kwargs)
+        return self.retry.call(self.invoke_once, ctx, service, args, kwargs)
+
+    def invoke_once(self, ctx, service, args, kwargs):
+        with self(ctx, force_new=True):
             return service(*args, **kwargs)
 
+class RoutingSessionManager(SessionManager):
+    """
+    A SessionManager which sends read-only sessions to replica databases.
+
+    db/manager:
+      :: pato.sqla.RoutingSessionManager
+      engine: <db/engine/primary>
+      replicas:
+        - <db/engine/replica1>
+        - <db/engine/replica2>
+
+    with sessionmgr(readonly=True) as session:
+        ... reads only
+
+    Replicas are used in turn.  A replica whose session fails with a
+    disconnect error (DBAPIError.connection_invalidated) is ejected for
+    eject_time seconds; if every replica is ejected then the primary is
+    used.  Read-only sessions are rolled back rather than committed.
+
+    As with SessionManager, an existing session in ctx is reused, so a
+    read-only block nested inside a read-write one still uses the
+    primary.  Asking for a read-write session inside a read-only one is
+    an error, unless force_new is set.
+    """
+
+    def __init__(self, engine, replicas=(), eject_time=30, **kwargs):
+        super(RoutingSessionManager, self).__init__(engine, **kwargs)
+        self.replicas = list(replicas)
+        self.eject_time = eject_time
+        self.ejected = {}       # {replica index: time when it can be used again}
+        self.next_replica = 0
+        self.lock = threading.Lock()
+
+    def choose_replica(self):
+        """Return the index of the next healthy replica, or None"""
+        with self.lock:
+            now = time.time()
+            for i in range(len(self.replicas)):
+                index = (self.next_replica + i) % len(self.replicas)
+                if self.ejected.get(index, 0) <= now:
+                    self.ejected.pop(index, None)
+                    self.next_replica = index + 1
+                    return index
+        return None
+
+    def eject(self, index):
+        log.warning("Ejecting database replica %d for %ss", index, self.eject_time)
+        with self.lock:
+            self.ejected[index] = time.time() + self.eject_time
+
+    def create_session(self, readonly=False, **options):
+        if not readonly:
+            return self.session_factory()
+        index = self.choose_replica()
+        bind = self.engine if index is None else self.replicas[index]
+        session = self.session_factory(bind=bind)
+        session.info["pato_readonly"] = True
+        session.info["pato_replica"] = index
+        return session
+
+    def is_readonly(self, session):
+        if isinstance(session, LazySession):
+            return session._options.get("readonly", False)
+        return session.info.get("pato_readonly", False)
+
+    def check_reuse(self, session, readonly=False, **options):
+        if not readonly and self.is_readonly(session):
+            raise ValueError("Cannot use a read-write session inside a read-only one")
+
+    def commit(self, session):
+        if not session.info.get("pato_readonly"):
+            session.commit()
+
+    def rollback(self, session, err):
+        index = session.info.get("pato_replica")
+        if index is not None and isinstance(err, DBAPIError) and err.connection_invalidated:
+            self.eject(index)
+        session.rollback()
+
+class WriteBuffer(object):
+    """
+    Collects parameterised insert (or upsert) statements made within a
+    SessionManager scope, and executes each distinct statement with all
+    its parameter sets at once (executemany), instead of one round trip
+    per row.
+
+    db/write_buffer:
+      :: pato.sqla.WriteBuffer
+      threshold: 1000
+
+    class Bar(object):
+        def __init__(self, buffer):
+            self.buffer = buffer
+        def __call__(self, id):
+            self.buffer.add("insert into foo (id) values (:id)", {"id": id})
+
+    Pending rows are kept with the session in ctx, and are written just
+    before the session commits, when a statement has threshold rows
+    pending, or when you call flush().  They are discarded if the session
+    rolls back, so the transaction behaves as if each row had been
+    written immediately - except that queries in the same transaction do
+    not see them until they have been flushed.  Rolling back a savepoint
+    (begin_nested) discards only the rows added since the savepoint, and
+    queues again any earlier rows which were flushed inside it.
+
+    The number of rows and batches written so far are in stats().
+    """
+
+    def __init__(self, threshold=1000, ctx_factory=get_ctx, attribute_name="db"):
+        self.threshold = threshold
+        self.ctx_factory = ctx_factory
+        self.attribute_name = attribute_name
+        self.rows = 0
+        self.batches = 0
+        self.lock = threading.Lock()
+
+    def session(self, session=None):
+        if session is None:
+            session = getattr(self.ctx_factory(), self.attribute_name)
+        if isinstance(session, LazySession):
+            session = session._get_session()
+        return session
+
+    def pending(self, session):
+        """Return {statement: [params]} for the given session"""
+        try:
+            return session.info[self]
+        except KeyError:
+            session.info[self] = pending = OrderedDict()
+            session.info[self, "savepoints"] = {}
+            event.listen(session, "before_commit", self.flush)
+            event.listen(session, "after_transaction_create", self.on_transaction_create)
+            event.listen(session, "after_transaction_end", self.on_transaction_end)
+            event.listen(session, "after_soft_rollback", self.on_rollback)
+            return pending
+
+    def on_transaction_create(self, session, transaction):
+        # Remember what was pending when a savepoint started, to go back
+        # to if it is rolled back
+        if transaction.nested:
+            session.info[self, "savepoints"][transaction] = OrderedDict(
+                (stmt, list(batch)) for (stmt, batch) in six.iteritems(session.info[self]))
+
+    def on_transaction_end(self, session, transaction):
+        if transaction.parent is None:
+            session.info[self, "savepoints"].clear()
+
+    def on_rollback(self, session, previous_transaction):
+        if previous_transaction.nested:
+            saved = session.info[self, "savepoints"].pop(previous_transaction, None)
+            if saved is not None:
+                pending = session.info[self]
+                pending.clear()
+                pending.update(saved)
+        elif previous_transaction.parent is None:
+            self.discard(session)
+
+    def add(self, statement, params, session=None):
+        """
+        Add a row. statement is SQL text with named parameters, or a
+        SQLAlchemy insert() construct; params is a dict.
+        """
+        session = self.session(session)
+        batch = self.pending(session).setdefault(statement, [])
+        batch.append(params)
+        if len(batch) >= self.threshold:
+            self.flush(session, statement)
+
+    def flush(self, session=None, statement=SENTINEL):
+        """Write pending rows for one statement, or all of them"""
+        session = self.session(session)
+        pending = session.info.get(self)
+        if not pending:
+            return
+        statements = list(pending) if statement is SENTINEL else [statement]
+        for stmt in statements:
+            batch = pending.pop(stmt, None)
+            if not batch:
+                continue
+            session.execute(text(stmt) if isinstance(stmt, six.string_types) else stmt, batch)
+            with self.lock:
+                self.rows += len(batch)
+                self.batches += 1
+
+    def discard(self, session):
+        pending = session.info.get(self)
+        if pending:
+            pending.clear()
+
+    def stats(self):
+        with self.lock:
+            return dict(rows=self.rows, batches=self.batches)
+
+class QueryCache(object):
+    """
+    Caches the results of read queries, such as reference data lookups.
+
+    db/query_cache:
+      :: pato.sqla.QueryCache
+      engine: <db/engine>
+      maxsize: 1000
+      ttl: 60
+
+    rows = cache.query("select * from country where code = :code", {"code": "GB"})
+
+    Results are keyed by the compiled SQL and parameters.  They are
+    memoised with the session in ctx, so repeating a query within a
+    SessionManager scope does not touch the database; and if maxsize is
+    non-zero, also in a process-wide LRU cache, for up to ttl seconds.
+
+    An insert, update or delete on a table through this engine makes the
+    session's memoised results for that table stale.  Until the
+    transaction ends, the process-wide cache is not used for that table
+    in the writing transaction; when it commits, the process-wide entries
+    for that table are dropped.  Writes by other processes are only seen
+    after ttl seconds.
+
+    Tables are found from the SQL text; pass tables=[...] to query() to
+    name them explicitly.  close() removes the cache's event listeners
+    from the engine.
+    """
+
+    READ_TABLES = re.compile(r"""\b(?:from|join)\s+([\w."`]+)""", re.I)
+    WRITE_TABLE = re.compile(
+        r"""^\s*(?:insert\s+(?:or\s+\w+\s+)?into|replace\s+into|update|delete\s+from|truncate(?:\s+table)?)\s+([\w."`]+)""",
+        re.I)
+
+    def __init__(self, engine, maxsize=0, ttl=None, ctx_factory=get_ctx, attribute_name="db"):
+        self.engine = engine
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.ctx_factory = ctx_factory
+        self.attribute_name = attribute_name
+        self.entries = OrderedDict()     # {key: (expires, tables, rows)}
+        self.by_table = {}               # {table: set of keys}
+        self.versions = {}               # {table: number of writes seen}
+        self.epochs = {}                 # {table: number of commits which wrote to it}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.key = "pato_query_cache_%x" % id(self)
+        self.listeners = [("after_cursor_execute", self.on_execute),
+                          ("commit", self.on_commit),
+                          ("rollback", self.on_rollback)]
+        for (name, func) in self.listeners:
+            event.listen(engine, name, func)
+
+    def close(self):
+        """Remove the event listeners from the engine"""
+        for (name, func) in self.listeners:
+            if event.contains(self.engine, name, func):
+                event.remove(self.engine, name, func)
+
+    @staticmethod
+    def table_name(name):
+        return name.strip('"`').lower()
+
+    def on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        match = self.WRITE_TABLE.match(statement)
+        if match:
+            table = self.table_name(match.group(1))
+            with self.lock:
+                self.versions[table] = self.versions.get(table, 0) + 1
+            conn.info.setdefault(self.key, set()).add(table)
+
+    def on_commit(self, conn):
+        written = conn.info.pop(self.key, None)
+        if written:
+            self.invalidate(*written)
+
+    def on_rollback(self, conn):
+        conn.info.pop(self.key, None)
+
+    def written(self, session):
+        """
+        The tables written by the session's transaction.  A session which
+        has not begun a transaction has written nothing, and asking it for
+        its connection would check one out.
+        """
+        in_transaction = getattr(session, "in_transaction", None)
+        if in_transaction is not None and not in_transaction():
+            return frozenset()
+        return session.connection().info.get(self.key, frozenset())
+
+    def invalidate(self, *tables):
+        """Drop process-wide entries which use any of the given tables"""
+        with self.lock:
+            for table in tables:
+                table = self.table_name(table)
+                self.epochs[table] = self.epochs.get(table, 0) + 1
+                for key in self.by_table.pop(table, ()):
+                    self.drop(key)
+
+    def drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            for table in entry[1]:
+                keys = self.by_table.get(table)
+                if keys:
+                    keys.discard(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.by_table.clear()
+
+    def session(self, session=None):
+        if session is None:
+            session = getattr(self.ctx_factory(), self.attribute_name)
+        if isinstance(session, LazySession):
+            session = session._get_session()
+        return session
+
+    def query(self, statement, params=None, tables=None, session=None):
+        """
+        Return a list of result rows, from the cache if possible.
+        statement is SQL text or a SQLAlchemy select() construct.
+        """
+        session = self.session(session)
+        params = params or {}
+        if isinstance(statement, six.string_types):
+            statement = text(statement)
+            sql, all_params = six.text_type(statement), params
+        else:
+            compiled = statement.compile(dialect=self.engine.dialect)
+            sql, all_params = six.text_type(compiled), dict(compiled.params, **params)
+        try:
+            key = (sql, tuple(sorted(six.iteritems(all_params))))
+            hash(key)
+        except TypeError:
+            return list(session.execute(statement, params))
+        if tables is None:
+            tables = self.READ_TABLES.findall(sql)
+        tables = frozenset(self.table_name(t) for t in tables)
+
+        # Memoised results are valid until there is a write to any of
+        # their tables, in any transaction
+        versions = tuple(self.versions.get(t, 0) for t in sorted(tables))
+        memo = session.info.setdefault(self.key, {})
+        entry = memo.get(key)
+        if entry and entry[0] == versions:
+            with self.lock:
+                self.hits += 1
+            return list(entry[1])
+
+        # The shared cache is not used for tables which this transaction
+        # has written to
+        shared = self.maxsize and not tables & self.written(session)
+        if shared:
+            now = time.time()
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry and (entry[0] is None or entry[0] > now):
+                    del self.entries[key]
+                    self.entries[key] = entry     # most recently used
+                    self.shared_hits += 1
+                    memo[key] = (versions, entry[2])
+                    return list(entry[2])
+                if entry:
+                    self.drop(key)
+
+        # A write committed while the query runs may not be in its
+        # results, but has already invalidated the shared cache; so the
+        # results are only shared if there was no such commit
+        epochs = tuple(self.epochs.get(t, 0) for t in sorted(tables))
+        rows = list(session.execute(statement, params))
+        memo[key] = (versions, rows)
+        with self.lock:
+            self.misses += 1
+            if shared and versions == tuple(self.versions.get(t, 0) for t in sorted(tables)) \
+                    and epochs == tuple(self.epochs.get(t, 0) for t in sorted(tables)):
+                expires = time.time() + self.ttl if self.ttl else None
+                self.entries[key] = (expires, tables, rows)
+                for table in tables:
+                    self.by_table.setdefault(table, set()).add(key)
+                while len(self.entries) > self.maxsize:
+                    self.drop(next(iter(self.entries)))
+        return list(rows)
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, shared_hits=self.shared_hits,
+                        misses=self.misses, size=len(self.entries))
+
+def stream(statement, params=None, chunk_size=1000, columns=False, array_factory=None,
+           session=None, ctx_factory=get_ctx, attribute_name="db"):
+    """
+    Run a query and yield its result rows in chunks of up to chunk_size,
+    so that large results can be processed with bounded memory:
+
+        with sessionmgr():
+            for rows in stream("select * from orders", chunk_size=5000):
+                writer.writerows(rows)
+
+    statement is SQL text, a SQLAlchemy select() construct or an ORM
+    Query, which is run in session, or by default the session in ctx.
+    Where the driver supports it (e.g. psycopg2, mysqlclient) a
+    server-side cursor is used, so rows are only fetched as needed; ORM
+    queries use yield_per.  The chunks must be consumed before the
+    session scope ends.
+
+    Each chunk is a list of rows, or with columns=True an OrderedDict of
+    {column name: list of values}.  If array_factory is given it is
+    applied to each column (or to the list of rows), e.g. numpy.array or
+    functools.partial(array.array, "d").
+    """
+    if session is None:
+        session = getattr(ctx_factory(), attribute_name)
+    if isinstance(session, LazySession):
+        session = session._get_session()
+    if hasattr(statement, "yield_per"):
+        query = statement.params(**params) if params else statement
+        result = None
+        rows = iter(query.yield_per(chunk_size))
+        keys = [c["name"] for c in query.column_descriptions]
+        fetch = lambda: list(islice(rows, chunk_size))
+    else:
+        if isinstance(statement, six.string_types):
+            statement = text(statement)
+        statement = statement.execution_options(stream_results=True)
+        result = session.execute(statement, params or {})
+        keys = list(result.keys())
+        fetch = lambda: result.fetchmany(chunk_size)
+    try:
+        while True:
+            chunk = fetch()
+            if not chunk:
+                break
+            if columns:
+                convert = array_factory or list
+                yield OrderedDict((k, convert(v)) for (k, v) in zip(keys, zip(*chunk)))
+            elif array_factory:
+                yield array_factory(chunk)
+            else:
+                yield chunk
+    finally:
+        if result is not None:
+            result.close()
+
+class StatementStats(object):
+    """
+    The SQL statements executed during one SessionManager scope
+    """
+    def __init__(self, top=5):
+        self.top = top
+        self.count = 0
+        self.total_time = 0.0
+        self.slowest = []       # heap of (elapsed, statement)
+        self.repeats = {}       # {statement: count}
+
+    def record(self, statement, elapsed):
+        self.count += 1
+        self.total_time += elapsed
+        self.repeats[statement] = self.repeats.get(statement, 0) + 1
+        if len(self.slowest) < self.top:
+            heapq.heappush(self.slowest, (elapsed, statement))
+        elif elapsed > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (elapsed, statement))
+
+    def slowest_statements(self):
+        """Return [(elapsed, statement)], slowest first"""
+        return sorted(self.slowest, reverse=True)
+
+    def repeated(self, threshold):
+        """Return [(count, statement)] for statements run at least threshold times"""
+        return sorted(((n, stmt) for (stmt, n) in six.iteritems(self.repeats) if n >= threshold),
+                      reverse=True)
+
+class StatementTracker(object):
+    """
+    Measures the SQL statements executed within each SessionManager scope.
+
+    db/tracker:
+      :: pato.sqla.StatementTracker
+      engine: <db/engine>
+      repeat_threshold: 10
+    db/manager:
+      :: pato.sqla.SessionManager
+      engine: <db/engine>
+      tracker: <db/tracker>
+
+    While the scope is active, ctx.db_stats is a StatementStats with the
+    number of statements, total time, the slowest statements and how many
+    times each statement was repeated.  At the end of the scope a summary
+    is logged, or passed to report(stats) if given; a statement repeated
+    repeat_threshold times or more (a likely N+1 query pattern) is logged
+    as a warning.  Nested scopes are counted in the outermost one.
+
+    Statements are attributed using the ctx from ctx_factory, so this
+    must be the same as the SessionManager's.
+    """
+
+    def __init__(self, engine, top=5, repeat_threshold=10, report=None,
+                 ctx_factory=get_ctx, attribute_name="db_stats"):
+        self.top = top
+        self.repeat_threshold = repeat_threshold
+        self.report = report or self.log_summary
+        self.ctx_factory = ctx_factory
+        self.attribute_name = attribute_name
+        event.listen(engine, "before_cursor_execute", self.before_execute)
+        event.listen(engine, "after_cursor_execute", self.after_execute)
+
+    # The start time is kept on the execution context (or the Connection,
+    # for the few statements run without one), so that nothing is left
+    # behind on the pooled connection when a statement fails
+
+    def before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        (conn if context is None else context)._pato_statement_start = timer()
+
+    def after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(conn if context is None else context, "_pato_statement_start", None)
+        if start is None:
+            return
+        elapsed = timer() - start
+        stats = getattr(self.ctx_factory(), self.attribute_name, None)
+        if stats is not None:
+            stats.record(statement, elapsed)
+
+    def start(self, ctx):
+        """Start recording, unless an outer scope already is"""
+        if getattr(ctx, self.attribute_name, None) is not None:
+            return False
+        setattr(ctx, self.attribute_name, StatementStats(self.top))
+        return True
+
+    def finish(self, ctx):
+        stats = getattr(ctx, self.attribute_name)
+        delattr(ctx, self.attribute_name)
+        self.report(stats)
+
+    def log_summary(self, stats):
+        if not stats.count:
+            return
+        log.info("%d SQL statements in %.3fs; slowest: %s", stats.count, stats.total_time,
+                 "; ".join("%.3fs %s" % s for s in stats.slowest_statements()))
+        for (count, statement) in stats.repeated(self.repeat_threshold):
+            log.warning("Statement executed %d times in one session (N+1 query?): %s",
+                        count, statement)
+
 class TestSessionManager(SessionManager):
     """
     A context manager for use in test suites. The session itself may
@@ -101,8 +1029,11 @@ class TestSessionManager(SessionManager):
     """
 
     @contextmanager
-    def __call__(self, ctx=None, force_new=False):
+    def __call__(self, ctx=None, force_new=False, **options):
         """
+        Options such as readonly are accepted and ignored: the test session
+        always uses this engine, and is always rolled back.
+
         There is deep magic here to allow our session to commit/rollback
         inside a single transaction, which we can roll back at the very end. See
         http://docs.sqlalchemy.org/en/rel_1_1/orm/session_transaction.html#session-external-transaction
@@ -133,3 +1064,152 @@ class TestSessionManager(SessionManager):
                     delattr(ctx, self.attribute_name)
                 else:
                     setattr(ctx, self.attribute_name, old_session)
+
+    @classmethod
+    def for_worker(cls, template, setup=None, **kwargs):
+        """
+        Create a TestSessionManager on this worker's copy of a template
+        database (see WorkerDatabase).  The WorkerDatabase is available
+        as the database attribute.
+
+        @fixture(scope="session")
+        def sessionmgr():
+            sm = TestSessionManager.for_worker("sqlite:////tmp/myapp.db", setup=create_schema)
+            yield sm
+            sm.database.drop()
+        """
+        database = WorkerDatabase(template, setup=setup, **kwargs)
+        sessionmgr = cls(database.engine)
+        sessionmgr.database = database
+        return sessionmgr
+
+class WorkerDatabase(object):
+    """
+    A database for one test worker process, copied from a template which
+    already contains the schema, so that parallel workers (e.g. pytest-xdist)
+    each get their own database without each building the schema.
+
+    For SQLite, template is the URL of a database file.  If the file does
+    not exist, it is built by calling setup(engine), and the worker's copy
+    is a file alongside it named after the worker.  Only one process
+    builds the template: the others wait for it, using a lock file
+    alongside (where fcntl is available).  If version is given, such as
+    the latest migration revision, it is recorded with the template, and
+    a template with a different version is rebuilt.  For other backends
+    (e.g. PostgreSQL), template names an existing database, and the worker's
+    copy is made with CREATE DATABASE ... TEMPLATE.
+
+    worker_id defaults to $PYTEST_XDIST_WORKER, or "main" if not set.  The
+    time taken to build the template and to copy it is in timings, and
+    is printed to stderr unless verbose is False.
+    """
+
+    def __init__(self, template, setup=None, worker_id=None, verbose=True, version=None,
+                 **engine_kwargs):
+        self.template = make_url(template)
+        self.version = None if version is None else six.text_type(version)
+        self.worker_id = worker_id or os.environ.get("PYTEST_XDIST_WORKER", "main")
+        self.timings = {}
+        start = timer()
+        if self.template.get_backend_name() == "sqlite":
+            self.url = self.copy_sqlite(setup)
+        else:
+            self.url = self.copy_server()
+        self.timings["total"] = timer() - start
+        if verbose:
+            print("pato: test database for worker %s ready in %.3fs (%s)" % (
+                self.worker_id, self.timings["total"], ", ".join(
+                    "%s %.3fs" % (k, v) for (k, v) in sorted(self.timings.items()) if k != "total")),
+                file=sys.stderr)
+        self.engine = create_engine(self.url, **engine_kwargs)
+
+    def copy_sqlite(self, setup):
+        path = self.template.database
+        if not self.template_ready(path):
+            if not setup:
+                raise ValueError("Template database %s does not exist" % path)
+            with self.template_lock(path):
+                # another worker may have built it while we waited
+                if not self.template_ready(path):
+                    self.build_template(path, setup)
+        start = timer()
+        base, ext = os.path.splitext(path)
+        self.path = "%s-%s%s" % (base, self.worker_id, ext or ".db")
+        shutil.copyfile(path, self.path)
+        self.timings["copy"] = timer() - start
+        return self.template.set(database=self.path)
+
+    def template_ready(self, path):
+        if not os.path.exists(path):
+            return False
+        if self.version is None:
+            return True
+        try:
+            with open(path + ".version") as f:
+                return f.read() == self.version
+        except IOError:
+            return False
+
+    @contextmanager
+    def template_lock(self, path):
+        if fcntl is None:
+            yield
+            return
+        with open(path + ".lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def build_template(self, path, setup):
+        start = timer()
+        # Build under a temporary name, so that other workers never
+        # see a partially built template
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        engine = create_engine(self.template.set(database=tmp), pool_stats=False)
+        try:
+            setup(engine)
+        finally:
+            engine.dispose()
+        os.rename(tmp, path)
+        if self.version is not None:
+            with open(path + ".version", "w") as f:
+                f.write(self.version)
+        self.timings["template"] = timer() - start
+
+    def copy_server(self):
+        start = timer()
+        self.path = None
+        self.name = "%s_%s" % (self.template.database, self.worker_id)
+        admin = self.admin_engine()
+        try:
+            with admin.connect() as conn:
+                conn.exec_driver_sql('DROP DATABASE IF EXISTS "%s"' % self.name)
+                conn.exec_driver_sql('CREATE DATABASE "%s" TEMPLATE "%s"' % (
+                    self.name, self.template.database))
+        finally:
+            admin.dispose()
+        self.timings["copy"] = timer() - start
+        return self.template.set(database=self.name)
+
+    def admin_engine(self):
+        # The template must not be in use while it is copied, so connect
+        # to the server's default database instead
+        return real_create_engine(self.template.set(database="postgres"),
+                                  isolation_level="AUTOCOMMIT")
+
+    def drop(self):
+        """Dispose of the engine and remove the worker's database"""
+        self.engine.dispose()
+        if self.path:
+            os.remove(self.path)
+        else:
+            admin = self.admin_engine()
+            try:
+                with admin.connect() as conn:
+                    conn.exec_driver_sql('DROP DATABASE IF EXISTS "%s"' % self.name)
+            finally:
+                admin.dispose()
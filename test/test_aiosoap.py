@@ -0,0 +1,81 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from concurrent.futures import ThreadPoolExecutor
+from pato.aiosoap import AsyncSOAPReceiver
+from pato.local import ContextLocal, setattrs
+import asyncio
+
+NS1 = {"Some-URI": "xyz"}
+MSG1 = """
+<SOAP-ENV:Envelope
+  xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">
+   <SOAP-ENV:Body>
+       <m:GetLastTradePrice xmlns:m="Some-URI">
+           <symbol>DIS</symbol>
+       </m:GetLastTradePrice>
+   </SOAP-ENV:Body>
+</SOAP-ENV:Envelope>"""
+
+def test_coroutine_app():
+    async def myapp(data):
+        await asyncio.sleep(0)
+        assert data["xyz:GetLastTradePrice"]["symbol"] == "DIS"
+        return {"xyz:GetLastTradePriceResponse": {"Price": 34.5}}
+    handler = AsyncSOAPReceiver(myapp, namespaces=NS1)
+    raw = asyncio.run(handler(MSG1))
+    assert "<Price>34.5</Price>" in raw
+
+def test_plain_app_and_offload():
+    def myapp(data):
+        return {"xyz:GetLastTradePriceResponse": {"Price": 34.5}}
+    with ThreadPoolExecutor(2) as executor:
+        handler = AsyncSOAPReceiver(myapp, namespaces=NS1, executor=executor, offload_size=0)
+        raw = asyncio.run(handler(MSG1))
+    assert "<Price>34.5</Price>" in raw
+
+def test_ctx():
+    ctx = ContextLocal()
+    async def myapp(data):
+        if data["xyz:GetLastTradePrice"]["symbol"] == "BAD":
+            raise RuntimeError("Wibble")
+        await asyncio.sleep(0.01)
+        return {"xyz:Ok": {"Status": "ok"}}
+    handler = AsyncSOAPReceiver(myapp, namespaces=NS1, ctx=ctx)
+    async def request(text):
+        with setattrs(ctx, error=False):
+            raw = await handler(text)
+            return raw, ctx.error
+    async def main():
+        return await asyncio.gather(request(MSG1), request(MSG1.replace("DIS", "BAD")))
+    (good, good_error), (bad, bad_error) = asyncio.run(main())
+    assert "xyz:Ok" in good
+    assert good_error is False
+    assert "Wibble" in bad
+    assert bad_error is True
+
+def test_max_in_flight():
+    release = []
+    async def myapp(data):
+        while not release:
+            await asyncio.sleep(0.01)
+        return {"xyz:Ok": {"Status": "ok"}}
+    handler = AsyncSOAPReceiver(myapp, namespaces=NS1, max_in_flight=1, acquire_timeout=0.05)
+    async def main():
+        first = asyncio.ensure_future(handler(MSG1))
+        await asyncio.sleep(0)
+        second = await handler(MSG1)
+        release.append(True)
+        return await first, second
+    first, second = asyncio.run(main())
+    assert "xyz:Ok" in first
+    assert "ServerBusy: Too many requests in progress" in second
+
+def test_max_in_flight_several_loops():
+    async def myapp(data):
+        await asyncio.sleep(0)
+        return {"xyz:Ok": {"Status": "ok"}}
+    handler = AsyncSOAPReceiver(myapp, namespaces=NS1, max_in_flight=1, acquire_timeout=1,
+                                offload_size=0)
+    async def main():
+        return await asyncio.gather(handler(MSG1), handler(MSG1))
+    for i in range(2):
+        assert all("xyz:Ok" in raw for raw in asyncio.run(main()))
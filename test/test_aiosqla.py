@@ -0,0 +1,61 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from pato.aiosqla import create_async_engine, AsyncSessionManager
+from pato.local import actx
+from pytest import raises
+from sqlalchemy import text
+import asyncio
+
+def run(tmpdir, test):
+    async def main():
+        engine = create_async_engine("sqlite+aiosqlite:///%s" % tmpdir.join("test.db"))
+        async with engine.begin() as conn:
+            await conn.execute(text("create table foo (id int)"))
+        try:
+            return await test(AsyncSessionManager(engine))
+        finally:
+            await engine.dispose()
+    return asyncio.run(main())
+
+COUNT = text("select count(*) from foo")
+INSERT = text("insert into foo (id) values (:id)")
+
+def test_nesting_and_commit(tmpdir):
+    async def test(sm):
+        async with sm() as s1:
+            assert actx.db is s1
+            async with sm() as s2:
+                assert s2 is s1
+            await s1.execute(INSERT, {"id": 1})
+            async with sm(force_new=True) as s3:
+                assert s3 is not s1
+                assert actx.db is s3
+                assert (await s3.execute(COUNT)).scalar() == 0
+            assert actx.db is s1
+        assert not hasattr(actx, "db")
+        async with sm() as s:
+            return (await s.execute(COUNT)).scalar()
+    assert run(tmpdir, test) == 1
+
+def test_rollback(tmpdir):
+    async def test(sm):
+        with raises(RuntimeError):
+            async with sm() as s:
+                await s.execute(INSERT, {"id": 1})
+                raise RuntimeError("bar")
+        async with sm() as s:
+            return (await s.execute(COUNT)).scalar()
+    assert run(tmpdir, test) == 0
+
+def test_invoke(tmpdir):
+    async def insert(id):
+        await actx.db.execute(INSERT, {"id": id})
+        return id
+    def plain():
+        return actx.db
+    async def test(sm):
+        results = await asyncio.gather(*[sm.invoke(insert, i) for i in range(3)])
+        assert results == [0, 1, 2]
+        session = await sm.invoke(plain)
+        assert session is not None
+        return await sm.invoke(lambda: actx.db.execute(COUNT))
+    assert run(tmpdir, test).scalar() == 3
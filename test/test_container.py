@@ -1,9 +1,10 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
-from pato.container import Container
+from pato.container import Container, BuildTimeout
 from pytest import raises
 import libtest.sample
 from six.moves.queue import Queue
-from threading import Thread
+from threading import Event, Thread
+import pato.container, sys, time
 
 def test_simple_values(c):
     c.load_yaml("""
@@ -361,3 +362,389 @@ def test_missing_required_file(c):
 def test_optional_file(c):
     c.load_yaml_file("NONEXISTENT", required=False)
     # assert nothing raised
+
+def test_references():
+    from pato.container import references
+    assert references({"::": "<factory>", "x": ["<a>.b", "<<c>", {"y": "<d>"}], "z": "e"}) == \
+        {"factory", "a", "d"}
+
+def test_reload(c, tmpdir):
+    f = tmpdir.join("services.yaml")
+    f.write("""
+a:
+    :: libtest.sample.Foo
+    username: abc
+    password: <password>
+b:
+    :: libtest.sample.Bar
+    x: <a>
+    y: 1
+d:
+    :: libtest.sample.Bar
+    x: 2
+    y: 3
+password: xyz
+""")
+    c.load_yaml_file(str(f))
+    c["e"] = "<d>"
+    a1, b1, d1 = c["a"], c["b"], c["d"]
+    assert c.reload() == set()
+
+    f.write(f.read().replace("xyz", "secret"))
+    assert c.reload() == {"password", "a", "b"}
+    assert c.services["a"] is not a1    # rebuilt before swapping in
+    assert c["a"].creds == "abc:secret"
+    assert c["b"].x is c["a"]
+    assert c["d"] is d1
+    assert c["e"] is d1
+
+    # a failed rebuild leaves everything as it was
+    a2 = c["a"]
+    f.write(f.read().replace("libtest.sample.Foo", "libtest.sample.Foo.bad_factory"))
+    with raises(TypeError):
+        c.reload()
+    assert c["a"] is a2
+    assert "libtest.sample.Foo" == c.definitions["a"][":"]
+
+def test_watch(c, tmpdir):
+    f = tmpdir.join("services.yaml")
+    f.write("a: 1\nb: [<a>]\nc: 3\n")
+    c.load_yaml_file(str(f))
+    assert c["b"] == [1]
+    q = Queue()
+    watcher = c.watch(interval=0.01, on_reload=q.put)
+    try:
+        f.write("a: 2\nb: [<a>]\nc: 3\n")
+        assert q.get(True, 2) == {"a", "b"}
+        assert c["b"] == [2]
+    finally:
+        watcher.stop()
+        watcher.join(2)
+
+def test_child(c):
+    c.load_yaml("""
+a:
+    :: libtest.sample.Foo
+    username: <username>
+    password: <password>
+b:
+    :: libtest.sample.Bar
+    x: <a>
+    y: <d>
+d:
+    :: libtest.sample.Bar
+    x: 1
+    y: 2
+username: abc
+password: xyz
+""")
+    c.resolve_all()
+    t = c.child({"password": "secret"})
+    assert t["d"] is c["d"]
+    assert t["username"] is c["username"]
+    assert t["a"] is not c["a"]
+    assert t["a"].creds == "abc:secret"
+    assert t["b"].x is t["a"]
+    assert t["b"].y is c["d"]
+    assert c["a"].creds == "abc:xyz"
+
+    report = t.report()
+    assert report["builds"] == {"password": 1, "a": 1, "b": 1}
+    assert report["overridden"] == 3
+    assert report["shared"] == 2
+    assert c.report()["builds"]["a"] == 1
+
+    t["e"] = "<d>"
+    assert t["e"] is c["d"]
+    t["d"] = 5
+    assert t["b"].y == 5
+    assert c["b"].y is c["d"]
+
+def test_child_of_child(c):
+    c.load_yaml("""
+a: [<b>, <c>]
+b: 1
+c: 2
+""")
+    t1 = c.child({"b": 10})
+    t2 = t1.child({"c": 20})
+    assert t2["a"] == [10, 20]
+    assert t1["a"] == [10, 2]
+    assert c["a"] == [1, 2]
+    with raises(ValueError) as e:
+        t2["z"]
+    assert "Undefined service 'z'" in str(e.value)
+
+def test_build_timeout(monkeypatch):
+    release = Event()
+    calls = []
+    def slow(x):
+        calls.append(x)
+        release.wait(2)
+        return x
+    c = Container(retry_after=10)
+    c["slow"] = slow
+    c.load_yaml("""
+a:
+    :: <slow>
+    :timeout: 0.05
+    x: 1
+b: [<a>]
+fast:
+    :: <slow>
+    :timeout: 5
+    x: 2
+""")
+    with raises(BuildTimeout) as e:
+        c["b"]
+    assert "While calling factory '<slow>'" in str(e.value)
+    assert "While resolving service 'a'" in str(e.value)
+    assert "While resolving service 'b'" in str(e.value)
+    assert len(calls) == 1
+
+    # failure is remembered, and re-raised without growing
+    for _ in range(2):
+        with raises(BuildTimeout) as e:
+            c["a"]
+        assert str(e.value).count("While resolving service 'a'") == 1
+        assert "service 'b'" not in str(e.value)
+    assert len(calls) == 1
+
+    release.set()
+    assert c["fast"] == 2
+    t = time.time() + 11
+    monkeypatch.setattr(pato.container.time, "time", lambda: t)
+    assert c["b"] == [1]
+
+def test_build_deadline():
+    release = Event()
+    def slow(x):
+        release.wait(2)
+        return x
+    c = Container(build_timeout=0.05)
+    c["slow"] = slow
+    c.load_yaml("""
+a:
+    :: <slow>
+    x: 1
+b:
+    :: libtest.sample.Bar
+    x: <a>
+    y: 2
+""")
+    with raises(BuildTimeout):
+        c["b"]
+    release.set()
+    del c["a"]
+    del c["b"]
+    assert c["b"].x == 1
+
+def test_failure_backoff(monkeypatch):
+    calls = []
+    def flaky(x):
+        calls.append(x)
+        if len(calls) < 3:
+            raise RuntimeError("down")
+        return x
+    c = Container(failure_backoff=1, max_backoff=3)
+    c["flaky"] = flaky
+    c.load_yaml("""
+a:
+    :: <flaky>
+    x: 1
+b: [<a>]
+""")
+    t = [1000]
+    monkeypatch.setattr(pato.container.time, "time", lambda: t[0])
+    with raises(RuntimeError):
+        c["a"]
+    with raises(RuntimeError) as e:
+        c["a"]
+    assert str(e.value).count("While resolving service 'a'") == 1
+    assert len(calls) == 1
+    (err, count, retry_in) = c.failed()["a"]
+    assert (count, retry_in) == (1, 1)
+
+    t[0] += 1
+    with raises(RuntimeError):
+        c["a"]
+    assert len(calls) == 2
+    assert c.failed()["a"][1:] == (2, 2)
+    t[0] += 1
+    with raises(RuntimeError):
+        c["a"]
+    assert len(calls) == 2
+    with raises(RuntimeError):
+        c["b"]
+    assert "b" in c.failed()
+
+    c.clear_failures("a")
+    assert c.failed() == {}
+    assert c["b"] == [1]
+
+def test_resolve_all_keep_going(c):
+    c.load_yaml("""
+a:
+    :: libtest.sample.Foo.bad_factory
+b: [<a>]
+c: 1
+d: <undefined>
+""")
+    with raises(RuntimeError):
+        c.resolve_all()
+    with raises(pato.container.ResolveError) as e:
+        c.resolve_all(keep_going=True)
+    assert sorted(e.value.errors) == ["a", "b", "d"]
+    assert "3 service(s) failed" in str(e.value)
+    assert c.services == {"c": 1}
+
+def test_derived_attributes(c):
+    class Config(object):
+        reads = 0
+        @property
+        def settings(self):
+            Config.reads += 1
+            return {"x": 1}
+    c["config_factory"] = Config
+    c.load_yaml("""
+config:
+    :: <config_factory>
+a: [<config>.settings, <config>.settings]
+b: [<config>.settings]
+d: <config>.
+""")
+    assert c["a"][0] is c["a"][1]
+    assert c["b"][0] is c["a"][0]
+    assert c["d"] is c["config"]
+    assert Config.reads == 1
+    assert c.report()["derived"] == 1
+
+    del c["b"]
+    c["b"]
+    assert Config.reads == 1
+    del c["config"]
+    del c["b"]
+    assert c["b"] == [{"x": 1}]
+    assert Config.reads == 2
+    c.expire()
+    assert c.derived == {}
+
+def test_import_cache(monkeypatch):
+    monkeypatch.setattr(pato.container, "import_cache", {})
+    assert pato.container.import_name("libtest.sample.Foo.my_class_method") == \
+        libtest.sample.Foo.my_class_method
+    assert pato.container.import_cache["libtest.sample.Foo.my_class_method"] == \
+        (libtest.sample, ["Foo", "my_class_method"])
+    # attributes are still looked up each time
+    monkeypatch.setattr(libtest.sample, "adder", max)
+    assert pato.container.import_name("libtest.sample.adder") is max
+    with raises(AttributeError):
+        pato.container.import_name("libtest.UNDEFINED")
+    assert "libtest.UNDEFINED" not in pato.container.import_cache
+
+def test_lazy_module(monkeypatch):
+    monkeypatch.delitem(sys.modules, "colorsys", raising=False)
+    m = pato.container.lazy_module("colorsys")
+    assert sys.modules["colorsys"] is m
+    assert m.rgb_to_hsv(1, 0, 0) == (0, 1, 1)
+    with raises(ImportError):
+        pato.container.lazy_module("libtest.nonexistent")
+
+def test_import_report(c, monkeypatch):
+    monkeypatch.setattr(pato.container, "import_cache", {})
+    monkeypatch.delitem(sys.modules, "colorsys", raising=False)
+    c.load_yaml("""
+a:
+    :: libtest.sample.Bar
+    x: <b>
+    y: 1
+b:
+    :: colorsys.rgb_to_hsv
+    r: 1
+    g: 0
+    b: 0
+""")
+    assert c.factory_names() == {"a": {"libtest.sample.Bar"}, "b": {"colorsys.rgb_to_hsv"}}
+    assert c["a"].x == (0, 1, 1)
+    report = c.import_report()
+    assert [name for (t, name, modules) in report] == ["b"]
+    assert report[0][2] == ["colorsys"]
+    assert c.imported_by["colorsys"] == "b"
+
+def test_prefetch(c, monkeypatch):
+    monkeypatch.setattr(pato.container, "import_cache", {})
+    monkeypatch.delitem(sys.modules, "colorsys", raising=False)
+    c.load_yaml("""
+a:
+    :: [colorsys.rgb_to_hsv, 1, 0, 0]
+b:
+    :: nonexistent.module
+""")
+    c.prefetch(background=True).join(2)
+    assert "colorsys" in sys.modules
+    assert "colorsys.rgb_to_hsv" in pato.container.import_cache
+
+def test_export():
+    c = Container(factory_key="class", failure_backoff=5)
+    c.load_yaml("""
+a:
+    class: libtest.sample.Foo
+    username: <username>
+    password: xyz
+username: abc
+b: [<a>, <c>]
+c: 3
+other: 4
+""")
+    c.load_dict({"c": 5})
+    data = c.export()
+    c2 = Container.from_export(data)
+    assert c2.definitions == c.definitions
+    assert c2.factory_key == "class"
+    assert c2.failure_backoff == 5
+    assert c2["a"].creds == "abc:xyz"
+    assert c2["b"][1] == 5
+
+    c3 = Container.from_export(c.export(["b"], plan=True))
+    assert sorted(c3.definitions) == ["a", "b", "c", "username"]
+    assert c3.plan.index("username") < c3.plan.index("a") < c3.plan.index("b")
+    c3.resolve_all()
+    c3["d"] = 7
+    assert c3.plan is None
+    assert "d" in c3.resolve_all()
+
+    with raises(ValueError) as e:
+        Container.from_export(data[:-1] + b"!")
+    assert "corrupt" in str(e.value)
+    with raises(ValueError):
+        Container.from_export(b"rubbish")
+
+def test_validate(c):
+    c.load_yaml("""
+a: <b>
+b: [<c>, <nothing>]
+c: <a>
+d: 1
+""")
+    assert c.validate(["d"]) == []
+    assert sorted(c.validate()) == ["Loop detected at service 'a'", "Undefined service 'nothing'"]
+    with raises(ValueError) as e:
+        c.export()
+    assert "Cannot export" in str(e.value)
+    # no recursion limit on deep graphs
+    c.load_dict(dict(("x%d" % i, "<x%d>" % (i + 1)) for i in range(5000)))
+    c["x5000"] = 1
+    assert c.validate(["x0"]) == []
+
+def test_export_shared(c):
+    c.load_yaml("""
+a: [<b>]
+b: 2
+""")
+    block = c.export_shared()
+    try:
+        c2 = Container.attach_shared(block.name)
+        assert c2["a"] == [2]
+    finally:
+        block.close()
+        block.unlink()
@@ -1,5 +1,5 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
-from pato.local import setattrs, local_factory, ctx, get_ctx
+from pato.local import setattrs, local_factory, ctx, get_ctx, ContextLocal
 from pytest import raises
 
 class AnyObject(object):
@@ -48,3 +48,21 @@ def test_setattrs_ctx():
         assert ctx.b == 'world'
     assert not hasattr(ctx, 'a')
     assert not hasattr(ctx, 'b')
+
+def test_context_local():
+    import asyncio
+    foo = ContextLocal()
+    foo.a = 'hello'
+    async def child(value):
+        assert foo.a == 'hello'
+        with setattrs(foo, a=value):
+            await asyncio.sleep(0)
+            assert foo.a == value
+        return foo.a
+    async def main():
+        return await asyncio.gather(child('one'), child('two'))
+    assert asyncio.run(main()) == ['hello', 'hello']
+    del foo.a
+    assert not hasattr(foo, 'a')
+    with raises(AttributeError):
+        del foo.a
@@ -0,0 +1,59 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from pato.memory import MemoryTracker, deep_size
+import libtest.sample
+
+def test_deep_size():
+    data = [str(i) * 1000 for i in range(10)]
+    (size, objects, complete) = deep_size(data)
+    assert size > 10000
+    assert objects == 11
+    assert complete
+    assert deep_size(data, exclude=[id(s) for s in data])[1] == 1
+    assert not deep_size(data, max_objects=5)[2]
+
+def test_memory_tracker(c):
+    tracker = MemoryTracker(c)
+    try:
+        check_memory_tracker(c, tracker)
+    finally:
+        tracker.stop()
+    assert c.memory is None
+
+def check_memory_tracker(c, tracker):
+    c.load_yaml("""
+a:
+    :: libtest.sample.Bar
+    x: <b>
+    y: 2
+b:
+    :: libtest.sample.Bar
+    x: 1
+    y: 2
+big:
+    :: bytearray
+    source: 100000
+""")
+    a1 = c["a"]
+    a1.y = [str(i) * 100 for i in range(100)]
+    c["big"]
+    report = tracker.report()
+    assert report["a"]["builds"] == 1
+    assert report["big"]["allocated"] > 50000
+    assert report["big"]["allocations"] > 0
+    assert report["big"]["size"] >= 100000
+    assert report["a"]["size"] > 10000       # does not include b
+    assert report["b"]["size"] < 10000
+    assert report["a"]["retired_alive"] == 0
+
+    c.expire()
+    c["a"]
+    report = tracker.report()
+    assert report["a"]["builds"] == 2
+    assert report["a"]["retired_alive"] == 1     # a1 is still referenced
+    assert report["b"]["retired_alive"] == 1     # by a1
+    assert report["big"]["retired_alive"] == 0
+    assert "size" in report["big"] and report["big"]["builds"] == 1
+    del a1
+    report = tracker.report()
+    assert report["a"]["retired_alive"] == 0
+    assert report["b"]["retired_alive"] == 0
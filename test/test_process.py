@@ -0,0 +1,101 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from pato.process import ProcessHost, ServiceProxy
+from pytest import raises
+import os
+
+def test_process_executor(c):
+    c.load_yaml("""
+pid:
+    :: [pato.container.import_name, os.getpid]
+    :executor: process
+adder:
+    :: [pato.container.import_name, <adder/name>]
+    :executor: <pool>
+adder/name: libtest.sample.adder
+foo:
+    :: libtest.sample.Foo
+    :executor: <pool>
+    username: abc
+    password: <password>
+password: xyz
+pool:
+    :: pato.process.ProcessHost
+    max_workers: 1
+""")
+    try:
+        assert isinstance(c["pid"], ServiceProxy)
+        assert c["pid"]() != os.getpid()
+        assert c["adder"](2, y=3) == 5
+        assert c["foo"].my_class_method("def").creds == "def:fixed"
+        with raises(RuntimeError) as e:
+            c["foo"].bad_factory()
+        assert "Bleurgh" in str(e.value)
+
+        stats = c["pool"].stats()
+        assert stats["workers"] == 1
+        assert stats["queue_depth"] == 0
+        assert stats["definitions_sent"] == 2    # adder and foo, once each
+        assert stats["calls"]["adder"]["calls"] == 1
+        assert stats["calls"]["foo.bad_factory"]["errors"] == 1
+        assert stats["calls"]["foo.my_class_method"]["total_time"] > 0
+        assert c.process_host.stats()["calls"]["pid"]["calls"] == 1
+
+        # redefining a dependency makes the workers rebuild the service
+        c["adder/name"] = "operator.mul"
+        del c["adder"]
+        assert c["adder"](2, 3) == 6
+        assert c["adder"](3, 3) == 9
+        assert c["pool"].stats()["definitions_sent"] == 3
+    finally:
+        c["pool"].shutdown()
+        c.close()
+        assert c.process_host is None
+
+def test_process_host_unpicklable(c):
+    c["lambda"] = lambda: 1
+    c["pool"] = ProcessHost(max_workers=1)
+    c.load_yaml("""
+x:
+    :: <lambda>
+    :executor: <pool>
+""")
+    with raises(Exception) as e:
+        c["x"]
+    assert "While resolving service 'x'" in str(e.value)
+    assert not c["pool"].stats()["started"]
+
+def test_process_executor_invalid(c):
+    c.load_yaml("""
+x:
+    :: libtest.sample.adder
+    :executor: procss
+""")
+    with raises(Exception) as e:
+        c["x"]
+    assert "Service 'x': :executor must be 'process'" in str(e.value)
+
+def test_process_host_shared(c, tmpdir):
+    path = tmpdir.join("services.yaml")
+    path.write("""
+x:
+    :: libtest.sample.adder
+    :executor: process
+y: 1
+""")
+    c.load_yaml_file(str(path))
+    host = c["x"]._host
+    assert host is c.process_host
+    child = c.child({"z": {":": "libtest.sample.adder", ":executor": "process"}})
+    assert child["z"]._host is host
+    assert child.process_host is None
+    path.write("""
+x:
+    :: libtest.sample.adder
+    :executor: process
+    :timeout: 10
+y: 1
+""")
+    assert c.reload(force=True) == {"x"}
+    assert c["x"]._host is host
+    c.close()
+    assert c.process_host is None
@@ -0,0 +1,83 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from datetime import date
+from decimal import Decimal
+from pato.schema import Schema
+from pato.soap import SOAPReceiver
+from pytest import raises
+
+NS = {"urn:orders": "xyz"}
+SPEC = {
+    "xyz:PlaceOrder": {
+        "@version": "int",
+        "customer": "str",
+        "urgent": "xsd:boolean",
+        "due": "date",
+        "lines": [{
+            "sku": "str",
+            "quantity": "int",
+            "price": "decimal",
+        }],
+        "notes": ["str"],
+        "weight": "xs:double",
+    },
+}
+MSG = """
+<env:Envelope xmlns:env="http://www.w3.org/2003/05/soap-envelope">
+ <env:Header><x:count xmlns:x="urn:orders">3</x:count></env:Header>
+ <env:Body>
+  <o:PlaceOrder xmlns:o="urn:orders" version="2">
+   <customer>ACME</customer>
+   <urgent>true</urgent>
+   <due>2016-08-01</due>
+   <lines><sku>A1</sku><quantity>3</quantity><price>1.50</price></lines>
+   <weight unit="kg">2.5</weight>
+  </o:PlaceOrder>
+ </env:Body>
+</env:Envelope>"""
+
+def receive(schema):
+    bodies = []
+    def myapp(body):
+        bodies.append(body)
+        return {"xyz:PlaceOrderResponse": {"ok": 1}}
+    handler = SOAPReceiver(myapp, namespaces=NS, schema=schema, trap_exception=False)
+    handler(MSG)
+    return bodies[0]["xyz:PlaceOrder"]
+
+def test_typed_values():
+    order = receive(SPEC)
+    assert order["@version"] == 2
+    assert order["customer"] == "ACME"
+    assert order["urgent"] is True
+    assert order["due"] == date(2016, 8, 1)
+    assert order["lines"] == [{"sku": "A1", "quantity": 3, "price": Decimal("1.50")}]
+    assert order["weight"] == {"@unit": "kg", "#text": 2.5}
+    assert "notes" not in order
+
+def test_records():
+    order = receive(Schema(SPEC, records=True))
+    assert type(order).__name__ == "PlaceOrder"
+    assert order.version == 2
+    assert order.customer == "ACME"
+    assert order.notes == []
+    assert len(order.lines) == 1
+    assert order.lines[0].quantity == 3
+    assert order.lines[0].price == Decimal("1.50")
+    assert not hasattr(order, "__dict__")
+    with raises(AttributeError):
+        order.undeclared = 1
+
+def test_invalid_spec():
+    with raises(ValueError) as e:
+        Schema({"xyz:Op": {"a": "wibble"}})
+    assert "Unknown type 'wibble' at 'xyz:Op/a'" in str(e.value)
+    with raises(ValueError) as e:
+        Schema({"xyz:Op": {"a": ["int", "str"]}})
+    assert "must have a single element type" in str(e.value)
+
+def test_invalid_value():
+    def myapp(body):
+        pass
+    handler = SOAPReceiver(myapp, namespaces=NS, schema=SPEC)
+    raw = handler(MSG.replace("<quantity>3", "<quantity>three"))
+    assert "ValueError: invalid literal for int()" in raw
@@ -6,7 +6,8 @@ SOAP12 test cases based on https://www.w3.org/TR/2007/REC-soap12-part0-20070427/
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 from collections import OrderedDict
-from pato.soap import SOAPReceiver, SOAP11_ENCODING_STYLE
+from pato.container import Container
+from pato.soap import SOAPReceiver, SOAPDispatcher, BatchSOAPReceiver, FaultPolicy, SOAP11_ENCODING_STYLE
 from pytest import fixture, raises
 import re
 
@@ -245,3 +246,188 @@ def test_no_trap():
     handler = SOAPReceiver(myapp, namespaces=NS1, trap_exception=False)
     with raises(RuntimeError) as e:
         handler(MSG1)
+
+def test_dispatch():
+    calls = []
+    def price(data):
+        calls.append("price")
+        assert data["xyz:GetLastTradePrice"]["symbol"] == "DIS"
+        return {"xyz:GetLastTradePriceResponse": {"Price": 34.5}}
+    def build_price():
+        calls.append("build")
+        return price
+    c = Container()
+    c["stock/price"] = {":": build_price}
+    c["stock/broken"] = {":": "libtest.sample.Foo.bad_factory"}
+    handler = SOAPDispatcher(c, {
+        "xyz:GetLastTradePrice": "stock/price",
+        "xyz:Other": "stock/broken",
+    }, namespaces=NS1)
+    assert calls == []
+    raw = handler(MSG1)
+    assert "<Price>34.5</Price>" in raw
+    assert 'xmlns:xyz="Some-URI"' in raw
+    handler(MSG1)
+    assert calls == ["build", "price", "price"]
+    stats = handler.stats()
+    assert list(stats) == ["xyz:GetLastTradePrice"]
+    assert stats["xyz:GetLastTradePrice"]["calls"] == 2
+    assert stats["xyz:GetLastTradePrice"]["errors"] == 0
+    assert stats["xyz:GetLastTradePrice"]["max_time"] >= stats["xyz:GetLastTradePrice"]["mean_time"]
+
+def test_dispatch_unknown_operation():
+    handler = SOAPDispatcher(Container(), {}, namespaces=NS1)
+    raw = handler(MSG1)
+    assert "<faultstring>ValueError: Unknown SOAP operation 'xyz:GetLastTradePrice'" in raw
+    assert handler.stats() == {}
+
+def test_dispatch_error_counted():
+    def price(data):
+        raise RuntimeError("Wibble")
+    c = Container()
+    c["stock/price"] = price
+    handler = SOAPDispatcher(c, {"xyz:GetLastTradePrice": "stock/price"}, namespaces=NS1)
+    raw = handler(MSG1)
+    assert "RuntimeError: Wibble" in raw
+    assert handler.stats()["xyz:GetLastTradePrice"]["errors"] == 1
+
+def test_fault_policy():
+    class NotFound(KeyError):
+        pass
+    def myapp(data):
+        symbol = data["xyz:GetLastTradePrice"]["symbol"]
+        if symbol == "DIS":
+            raise NotFound(symbol)
+        raise RuntimeError("Wibble %s" % symbol)
+    policy = FaultPolicy(faults={
+        KeyError: ("Client", "No such symbol"),
+        "ValueError": ("Server", None),
+    })
+    handler = SOAPReceiver(myapp, namespaces=NS1, fault_policy=policy)
+    raw = handler(MSG1)
+    assert re.match(r"""^
+    \s* <env:Envelope\s+xmlns:env="http://schemas.xmlsoap.org/soap/envelope/">
+    \s* <env:Body>
+    \s* <env:Fault>
+    \s* <faultcode>env:Client</faultcode>
+    \s* <faultstring>No\ssuch\ssymbol</faultstring>
+    \s* </env:Fault>
+    \s* </env:Body>
+    \s* </env:Envelope>
+    \s* $""", raw, re.VERBOSE)
+    assert handler(MSG1) is raw
+    raw = handler(MSG1.replace("DIS", "ABC"))
+    assert "<faultstring>RuntimeError: Wibble ABC</faultstring>" in raw
+    assert "<detail>" not in raw
+
+def test_fault_policy_soap12():
+    def myapp(data):
+        raise KeyError("x")
+    handler = SOAPReceiver(myapp, namespaces=NS2,
+                           fault_policy=FaultPolicy({KeyError: ("Client", "Bad request")}))
+    raw = handler(MSG2)
+    assert "<env:Value>env:Sender</env:Value>" in raw
+    assert "<env:Text>Bad request</env:Text>" in raw
+    assert "env:Detail" not in raw
+
+def test_fault_policy_traceback_limit():
+    def myapp(data):
+        raise RuntimeError("Wibble")
+    policy = FaultPolicy(traceback_rate=1.0, max_tracebacks=2, period=3600)
+    handler = SOAPReceiver(myapp, namespaces=NS1, fault_policy=policy)
+    details = ["<detail>" in handler(MSG1) for i in range(4)]
+    assert details == [True, True, False, False]
+
+def test_fault_policy_shared():
+    def myapp(data):
+        raise KeyError("x")
+    policy = FaultPolicy({KeyError: ("Client", "Bad request")})
+    pretty = SOAPReceiver(myapp, namespaces=NS1, fault_policy=policy)
+    compact = SOAPReceiver(myapp, namespaces=NS1, fault_policy=policy,
+                           unparse_options=dict(pretty=False, full_document=False))
+    assert "\n" in pretty(MSG1)
+    assert "\n" not in compact(MSG1)
+    assert "\n" in pretty(MSG1)
+
+MSG3 = """
+<SOAP-ENV:Envelope
+  xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">
+   <SOAP-ENV:Body>
+       <m:GetLastTradePrice xmlns:m="Some-URI"><symbol>DIS</symbol></m:GetLastTradePrice>
+       <m:GetLastTradePrice xmlns:m="Some-URI"><symbol>BAD</symbol></m:GetLastTradePrice>
+       <m:GetLastTradePrice xmlns:m="Some-URI"><symbol>IBM</symbol></m:GetLastTradePrice>
+       <m:GetCompanyName xmlns:m="Some-URI"><symbol>IBM</symbol></m:GetCompanyName>
+   </SOAP-ENV:Body>
+</SOAP-ENV:Envelope>"""
+
+def test_batch():
+    import pato.local, threading, time
+    ctx = pato.local.local_factory()
+    threads = set()
+    def myapp(data):
+        assert len(data) == 1
+        threads.add(threading.current_thread())
+        assert ctx.request_id == 99
+        if "xyz:GetCompanyName" in data:
+            assert ctx.soap_index == 3
+            return {"xyz:GetCompanyNameResponse": {"Name": "IBM Corp"}}
+        symbol = data["xyz:GetLastTradePrice"]["symbol"]
+        if symbol == "BAD":
+            raise RuntimeError("Wibble")
+        time.sleep(0.05 if symbol == "DIS" else 0)
+        return {"xyz:GetLastTradePriceResponse": {"Symbol": symbol}}
+    handler = BatchSOAPReceiver(myapp, namespaces=NS1, local=ctx, inherit=["request_id"],
+                                ctx=ctx)
+    ctx.request_id = 99
+    raw = handler(MSG3)
+    assert re.match(r"""^
+    \s* <env:Envelope\s+xmlns:env="http://schemas.xmlsoap.org/soap/envelope/"\s+xmlns:xyz="Some-URI">
+    \s* <env:Body>
+    \s* <Result\s+index="0"\s+operation="xyz:GetLastTradePrice">
+    \s* <xyz:GetLastTradePriceResponse>\s*<Symbol>DIS</Symbol>\s*</xyz:GetLastTradePriceResponse>
+    \s* </Result>
+    \s* <Result\s+index="1"\s+operation="xyz:GetLastTradePrice">
+    \s* <Error>
+    \s* <Code>Server</Code>
+    \s* <Reason>RuntimeError:\sWibble</Reason>
+    \s* <Detail>.*</Detail>
+    \s* </Error>
+    \s* </Result>
+    \s* <Result\s+index="2"\s+operation="xyz:GetLastTradePrice">
+    \s* <xyz:GetLastTradePriceResponse>\s*<Symbol>IBM</Symbol>\s*</xyz:GetLastTradePriceResponse>
+    \s* </Result>
+    \s* <Result\s+index="3"\s+operation="xyz:GetCompanyName">
+    \s* <xyz:GetCompanyNameResponse>\s*<Name>IBM\sCorp</Name>\s*</xyz:GetCompanyNameResponse>
+    \s* </Result>
+    \s* </env:Body>
+    \s* </env:Envelope>
+    \s* $""", raw, re.VERBOSE|re.DOTALL)
+    assert threading.current_thread() not in threads
+    assert ctx.error is True
+    assert ctx.exc_info[0] is RuntimeError
+    assert not hasattr(ctx, "soap_index")
+
+MSG4 = """
+<SOAP-ENV:Envelope
+  xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">
+   <SOAP-ENV:Body>
+       <m:GetLastTradePrice xmlns:m="Some-URI"><symbol>DIS</symbol></m:GetLastTradePrice>
+       <m:GetCompanyName xmlns:m="Some-URI"><symbol>IBM</symbol></m:GetCompanyName>
+       <m:GetLastTradePrice xmlns:m="Some-URI"><symbol>IBM</symbol></m:GetLastTradePrice>
+   </SOAP-ENV:Body>
+</SOAP-ENV:Envelope>"""
+
+def test_batch_document_order():
+    def myapp(data):
+        ((name, value),) = data.items()
+        return {name + "Response": {"Symbol": value["symbol"]}}
+    handler = BatchSOAPReceiver(myapp, namespaces=NS1)
+    raw = handler(MSG4)
+    assert re.findall(r'<Result index="(\d)" operation="([\w:]+)">\s*<[\w:]+>\s*<Symbol>(\w+)', raw) == [
+        ("0", "xyz:GetLastTradePrice", "DIS"),
+        ("1", "xyz:GetCompanyName", "IBM"),
+        ("2", "xyz:GetLastTradePrice", "IBM"),
+    ]
+    assert "<env:Body></env:Body>" in handler(
+        '<e:Envelope xmlns:e="http://www.w3.org/2003/05/soap-envelope"><e:Body/></e:Envelope>')
+    assert handler("<foo><bar><baz/></bar></foo>") == "Missing SOAP Envelope"
@@ -1,5 +1,8 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
-from pato.sqla import SessionManager, TestSessionManager
+from pato.sqla import create_engine, PoolStats, SessionManager, RoutingSessionManager, TestSessionManager, WriteBuffer, QueryCache, WorkerDatabase, StatementTracker, RetryPolicy, stream
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.pool import QueuePool
 from pytest import raises
 
 class AnyObject():
@@ -63,3 +66,529 @@ def test_arg():
             assert arg.db is s1
         assert arg.db is s1
     assert not hasattr(arg, 'db')
+
+def test_lazy():
+    sessions = []
+    def factory():
+        sessions.append(MockSession())
+        return sessions[-1]
+    sm = SessionManager(engine=None, session_factory=factory, lazy=True)
+    arg = AnyObject()
+    with sm(arg) as s1:
+        assert arg.db is s1
+        with sm(arg) as s2:
+            assert s2 is s1
+    assert sessions == []
+    assert sm.invoke(lambda: 42) == 42
+    assert sessions == []
+    with sm(arg) as s1:
+        assert s1.calls == []
+        assert len(sessions) == 1
+    assert sessions[0].calls == [
+        ('commit', (), {}),
+        ('close', (), {}),
+    ]
+    with raises(RuntimeError):
+        with sm(arg) as s1:
+            raise RuntimeError("bar")
+    assert len(sessions) == 1
+
+class MockContainerSession(MockSession):
+    autoflush = True
+    def __init__(self):
+        MockSession.__init__(self)
+        self.objects = ["a", "b"]
+    def __contains__(self, obj):
+        return obj in self.objects
+    def __iter__(self):
+        return iter(self.objects)
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        self.close()
+
+def test_lazy_passthrough():
+    sm = SessionManager(engine=None, session_factory=MockContainerSession, lazy=True)
+    arg = AnyObject()
+    with sm(arg) as s:
+        s.autoflush = False
+        real = s._session
+        assert real.autoflush is False
+        s.extra = 1
+        assert real.extra == 1
+        del s.extra
+        assert not hasattr(real, "extra")
+    with sm(arg) as s:
+        assert "a" in s and "c" not in s
+        assert s._session is not None
+    with sm(arg) as s:
+        assert list(s) == ["a", "b"]
+    with sm(arg) as s:
+        with s as inner:
+            assert inner is s._session
+        assert s._session.calls == [('close', (), {})]
+
+class PgError(Exception):
+    pgcode = "40001"
+
+def test_retry_transient():
+    rp = RetryPolicy()
+    assert rp.is_transient(OperationalError("UPDATE", {}, Exception("database is locked")))
+    assert rp.is_transient(DBAPIError("UPDATE", {}, PgError("could not serialize access")))
+    assert rp.is_transient(DBAPIError("UPDATE", {}, Exception(1213, "Deadlock found")))
+    assert not rp.is_transient(DBAPIError("UPDATE", {}, Exception(1062, "Duplicate entry")))
+    assert not rp.is_transient(OperationalError("SELECT", {}, Exception("no such table: foo")))
+    assert not rp.is_transient(ValueError("database is locked"))
+    lost = DBAPIError("COMMIT", {}, Exception("server closed the connection"),
+                      connection_invalidated=True)
+    assert not rp.is_transient(lost)
+    assert RetryPolicy(retry_disconnects=True).is_transient(lost)
+
+def test_retry_invoke():
+    sleeps = []
+    rp = RetryPolicy(max_attempts=3, base_delay=0.1, sleep=sleeps.append)
+    sm = SessionManager(engine=None, session_factory=MockSession, retry=rp)
+    sessions = []
+    def service(n):
+        sessions.append(sm.ctx_factory().db)
+        if len(sessions) < n:
+            raise OperationalError("UPDATE", {}, Exception("database is locked"))
+        return "ok"
+    assert sm.invoke(service, 2) == "ok"
+    assert len(sessions) == 2 and sessions[0] is not sessions[1]
+    assert sessions[0].calls == [('rollback', (), {}), ('close', (), {})]
+    assert sessions[1].calls == [('commit', (), {}), ('close', (), {})]
+    assert len(sleeps) == 1 and 0 <= sleeps[0] <= 0.1
+
+    del sessions[:]
+    with raises(OperationalError):
+        sm.invoke(service, 5)
+    assert len(sessions) == 3
+    assert rp.stats() == dict(calls=2, attempts=5, retries=3, recovered=1,
+                              exhausted=1, budget_denied=0)
+
+    # no retry inside an outer session
+    del sessions[:]
+    with sm():
+        with raises(OperationalError):
+            sm.invoke(service, 2)
+    assert len(sessions) == 1
+    assert rp.stats()["calls"] == 2
+
+    # other errors are not retried
+    def fail():
+        raise ValueError("foo")
+    with raises(ValueError):
+        sm.invoke(fail)
+    assert rp.stats()["attempts"] == 6
+
+def test_retry_budget():
+    rp = RetryPolicy(max_attempts=10, budget=0.5, min_retries=2, sleep=lambda t: None)
+    def fail():
+        raise OperationalError("UPDATE", {}, Exception("database is locked"))
+    with raises(OperationalError):
+        rp.call(fail)
+    assert rp.stats()["retries"] == 2
+    assert rp.stats()["budget_denied"] == 1
+    rp.call(lambda: None)
+    rp.call(lambda: None)
+    with raises(OperationalError):
+        rp.call(fail)
+    assert rp.stats()["retries"] == 3
+
+def test_pool_stats(tmpdir, caplog):
+    stats = PoolStats(slow_checkout=0)
+    engine = create_engine("sqlite:///%s" % tmpdir.join("test.db"), poolclass=QueuePool,
+                           pool_size=2, max_overflow=0, pool_stats=stats)
+    assert engine.pool_stats is stats
+    c1 = engine.connect()
+    c2 = engine.connect()
+    res = stats.snapshot()
+    assert res["checkouts"] == 2
+    assert res["in_use"] == 2
+    assert res["pool_size"] == 2
+    assert res["pool_checkedout"] == 2
+    c1.close()
+    c2.invalidate()
+    c2.close()
+    res = stats.snapshot()
+    assert res["in_use"] == 0
+    assert res["peak_in_use"] == 2
+    assert res["invalidations"] == 1
+    assert res["held_max"] > 0
+    assert res["slow_checkouts"] == 2
+    assert "Slow connection checkout" in caplog.text
+
+def test_pool_stats_dispose(tmpdir):
+    stats = PoolStats(slow_checkout=0)
+    engine = create_engine("sqlite:///%s" % tmpdir.join("test.db"), poolclass=QueuePool,
+                           pool_size=2, max_overflow=0, pool_stats=stats)
+    engine.connect().close()
+    engine.dispose()
+    c1 = engine.connect()
+    c2 = engine.connect()
+    res = stats.snapshot()
+    assert res["checkouts"] == 3
+    assert res["in_use"] == 2
+    assert res["pool_checkedout"] == 2
+    assert res["slow_checkouts"] == 3
+    assert res["wait_total"] > 0
+    c1.close()
+    c2.close()
+    assert stats.snapshot()["in_use"] == 0
+    engine.execution_options(isolation_level="SERIALIZABLE").connect().close()
+    assert stats.snapshot()["slow_checkouts"] == 4
+
+def test_pool_stats_disabled():
+    engine = create_engine("sqlite://", pool_stats=False)
+    assert not hasattr(engine, "pool_stats")
+
+def make_db(tmpdir, name):
+    engine = create_engine("sqlite:///%s" % tmpdir.join(name + ".db"))
+    with engine.begin() as conn:
+        conn.execute("create table dbname (name text)")
+        conn.execute("insert into dbname values ('%s')" % name)
+    return engine
+
+def test_routing(tmpdir):
+    sm = RoutingSessionManager(make_db(tmpdir, "primary"),
+                               replicas=[make_db(tmpdir, "r1"), make_db(tmpdir, "r2")])
+    query = "select name from dbname"
+    with sm() as s:
+        assert s.execute(query).scalar() == "primary"
+        with sm(readonly=True) as s2:
+            assert s2 is s
+    names = []
+    for i in range(3):
+        with sm(readonly=True) as s:
+            names.append(s.execute(query).scalar())
+            with sm(readonly=True) as s2:
+                assert s2 is s
+            with raises(ValueError) as e:
+                with sm():
+                    pass
+            assert "read-write session inside a read-only one" in str(e.value)
+            with sm(force_new=True) as s3:
+                assert s3.execute(query).scalar() == "primary"
+    assert names == ["r1", "r2", "r1"]
+
+def test_routing_eject(tmpdir):
+    sm = RoutingSessionManager(make_db(tmpdir, "primary"),
+                               replicas=[make_db(tmpdir, "r1"), make_db(tmpdir, "r2")])
+    query = "select name from dbname"
+    with raises(DBAPIError):
+        with sm(readonly=True) as s:
+            assert s.execute(query).scalar() == "r1"
+            raise DBAPIError(query, {}, Exception("gone away"), connection_invalidated=True)
+    with sm(readonly=True) as s:
+        assert s.execute(query).scalar() == "r2"
+    with raises(DBAPIError):
+        with sm(readonly=True) as s:
+            raise DBAPIError(query, {}, Exception("gone away"), connection_invalidated=True)
+    with sm(readonly=True) as s:
+        assert s.execute(query).scalar() == "primary"
+    sm.ejected[0] = 0
+    with sm(readonly=True) as s:
+        assert s.execute(query).scalar() == "r1"
+
+def test_routing_lazy(tmpdir):
+    sm = RoutingSessionManager(make_db(tmpdir, "primary"), replicas=[make_db(tmpdir, "r1")],
+                               lazy=True)
+    with sm(readonly=True) as s:
+        with raises(ValueError):
+            with sm():
+                pass
+        assert s._session is None
+        assert s.execute("select name from dbname").scalar() == "r1"
+
+def test_readonly_any_manager(tmpdir):
+    engine = make_db(tmpdir, "primary")
+    for sm in (SessionManager(engine), SessionManager(engine, lazy=True),
+               RoutingSessionManager(engine), TestSessionManager(engine)):
+        with sm(readonly=True) as s:
+            assert s.execute("select name from dbname").scalar() == "primary"
+            with sm(readonly=True) as s2:
+                assert s2 is s
+        with sm() as s:
+            with sm(readonly=True) as s2:
+                assert s2 is s
+
+def test_write_buffer(tmpdir):
+    engine = make_db(tmpdir, "primary")
+    with engine.begin() as conn:
+        conn.execute("create table foo (id int)")
+    executed = []
+    @event.listens_for(engine, "before_cursor_execute")
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("insert"):
+            executed.append((statement, executemany))
+    sm = SessionManager(engine, lazy=True)
+    buffer = WriteBuffer(threshold=3)
+    count = "select count(*) from foo"
+    with sm() as s:
+        for i in range(4):
+            buffer.add("insert into foo (id) values (:id)", {"id": i})
+        assert s.execute(count).scalar() == 3
+        buffer.add("insert into foo (id) values (:id)", {"id": 4})
+    assert buffer.stats() == {"rows": 5, "batches": 2}
+    assert executed == [("insert into foo (id) values (?)", True)] * 2
+    with raises(RuntimeError):
+        with sm() as s:
+            buffer.add("insert into foo (id) values (:id)", {"id": 5})
+            raise RuntimeError("bar")
+    with sm() as s:
+        assert s.execute(count).scalar() == 5
+        buffer.add("insert into foo (id) values (:id)", {"id": 6})
+        buffer.flush()
+        assert s.execute(count).scalar() == 6
+    assert buffer.stats() == {"rows": 6, "batches": 3}
+
+def test_write_buffer_savepoint(tmpdir):
+    engine = make_db(tmpdir, "primary")
+    with engine.begin() as conn:
+        conn.execute("create table foo (id int)")
+    sm = SessionManager(engine)
+    buffer = WriteBuffer(threshold=3)
+    insert = "insert into foo (id) values (:id)"
+    with sm() as s:
+        buffer.add(insert, {"id": 1})
+        savepoint = s.begin_nested()
+        buffer.add(insert, {"id": 2})
+        savepoint.rollback()
+        savepoint = s.begin_nested()
+        buffer.add(insert, {"id": 3})
+        buffer.add(insert, {"id": 4})    # reaches the threshold; 1 is flushed
+        savepoint.rollback()
+        savepoint = s.begin_nested()
+        buffer.add(insert, {"id": 5})
+        savepoint.commit()
+    with sm() as s:
+        assert [r[0] for r in s.execute("select id from foo order by id")] == [1, 5]
+
+def test_query_cache(tmpdir):
+    engine = make_db(tmpdir, "primary")
+    queries = []
+    @event.listens_for(engine, "before_cursor_execute")
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("select"):
+            queries.append(statement)
+    sm = SessionManager(engine)
+    cache = QueryCache(engine, maxsize=10, ttl=60)
+    query = "select name from dbname where name like :pattern"
+    with sm():
+        assert cache.query(query, {"pattern": "p%"}) == [("primary",)]
+        assert cache.query(query, {"pattern": "p%"}) == [("primary",)]
+        assert cache.query(query, {"pattern": "x%"}) == []
+    assert len(queries) == 2
+    with sm() as s:
+        assert cache.query(query, {"pattern": "p%"}) == [("primary",)]
+        assert len(queries) == 2
+        s.execute("insert into dbname values ('pending')")
+        # own write is seen; the shared cache is bypassed
+        assert len(cache.query(query, {"pattern": "p%"})) == 2
+        assert len(cache.query(query, {"pattern": "p%"})) == 2
+        assert len(queries) == 3
+    assert cache.stats() == {"hits": 2, "shared_hits": 1, "misses": 3, "size": 0}
+    with sm():
+        assert len(cache.query(query, {"pattern": "p%"})) == 2
+        assert len(queries) == 4
+
+def test_query_cache_shared_hit_no_connection(tmpdir):
+    engine = make_db(tmpdir, "primary")
+    checkouts = []
+    event.listen(engine, "checkout", lambda *args: checkouts.append(1))
+    sm = SessionManager(engine, lazy=True)
+    cache = QueryCache(engine, maxsize=10)
+    query = "select name from dbname"
+    with sm():
+        assert cache.query(query) == [("primary",)]
+    assert len(checkouts) == 1
+    with sm():
+        assert cache.query(query) == [("primary",)]
+    assert len(checkouts) == 1
+    assert cache.stats()["shared_hits"] == 1
+
+def test_query_cache_close(tmpdir):
+    import gc, weakref
+    engine = make_db(tmpdir, "primary")
+    cache = QueryCache(engine, maxsize=10)
+    assert event.contains(engine, "commit", cache.on_commit)
+    cache.close()
+    assert not event.contains(engine, "commit", cache.on_commit)
+    ref = weakref.ref(cache)
+    del cache
+    gc.collect()
+    assert ref() is None
+
+def test_query_cache_commit_during_read(tmpdir):
+    engine = make_db(tmpdir, "primary")
+    with engine.connect() as conn:
+        conn.execute("pragma journal_mode=wal")
+    sm = SessionManager(engine)
+    cache = QueryCache(engine, maxsize=10)
+    query = "select count(*) from dbname"
+    writer = engine.connect()
+    trans = writer.begin()
+    writer.execute("insert into dbname values ('other')")
+    @event.listens_for(engine, "after_cursor_execute")
+    def commit_writer(conn, cursor, statement, parameters, context, executemany):
+        if statement == query and trans.is_active:
+            trans.commit()
+    with sm():
+        assert cache.query(query) == [(1,)]     # read before the commit
+    writer.close()
+    with sm():
+        assert cache.query(query) == [(2,)]
+    assert cache.stats()["shared_hits"] == 0
+
+def test_query_cache_rollback(tmpdir):
+    engine = make_db(tmpdir, "primary")
+    sm = SessionManager(engine)
+    cache = QueryCache(engine, maxsize=10)
+    query = "select count(*) from dbname"
+    with raises(RuntimeError):
+        with sm() as s:
+            s.execute("insert into dbname values ('pending')")
+            assert cache.query(query) == [(2,)]
+            raise RuntimeError("bar")
+    with sm():
+        assert cache.query(query) == [(1,)]
+        assert cache.query(query) == [(1,)]
+    with sm():
+        assert cache.query(query) == [(1,)]
+    assert cache.stats()["shared_hits"] == 1
+
+def test_worker_database(tmpdir, capsys):
+    calls = []
+    def setup(engine):
+        calls.append(engine)
+        with engine.begin() as conn:
+            conn.execute("create table foo (id int)")
+    template = "sqlite:///%s" % tmpdir.join("template.db")
+    sm = TestSessionManager.for_worker(template, setup=setup, worker_id="gw0")
+    db1 = WorkerDatabase(template, setup=setup, worker_id="gw1", verbose=False)
+    assert len(calls) == 1
+    assert sorted(f.basename for f in tmpdir.listdir()) == \
+        ["template-gw0.db", "template-gw1.db", "template.db", "template.db.lock"]
+    assert "worker gw0 ready" in capsys.readouterr().err
+    assert set(db1.timings) == {"copy", "total"}
+    assert set(sm.database.timings) == {"copy", "template", "total"}
+    with sm() as s:
+        s.execute("insert into foo values (1)")
+        s.commit()
+        assert s.execute("select count(*) from foo").scalar() == 1
+    with sm() as s:
+        assert s.execute("select count(*) from foo").scalar() == 0
+    sm.database.drop()
+    db1.drop()
+    assert sorted(f.basename for f in tmpdir.listdir()) == ["template.db", "template.db.lock"]
+
+def test_worker_database_concurrent_build(tmpdir):
+    import threading, time
+    calls = []
+    def setup(engine):
+        calls.append(engine)
+        time.sleep(0.1)
+        with engine.begin() as conn:
+            conn.execute("create table foo (id int)")
+    template = "sqlite:///%s" % tmpdir.join("template.db")
+    dbs = []
+    threads = [threading.Thread(target=lambda i=i: dbs.append(
+                   WorkerDatabase(template, setup=setup, worker_id="gw%d" % i, verbose=False)))
+               for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert len(dbs) == 4
+    for db in dbs:
+        with db.engine.connect() as conn:
+            assert conn.execute("select count(*) from foo").scalar() == 0
+        db.drop()
+
+def test_worker_database_version(tmpdir):
+    tables = []
+    def setup(engine):
+        with engine.begin() as conn:
+            conn.execute("create table %s (id int)" % tables[-1])
+    template = "sqlite:///%s" % tmpdir.join("template.db")
+    def table_names(db):
+        with db.engine.connect() as conn:
+            return [r[0] for r in conn.execute("select name from sqlite_master")]
+    tables.append("foo")
+    db = WorkerDatabase(template, setup=setup, version="1", verbose=False)
+    assert table_names(db) == ["foo"]
+    assert "template" in db.timings
+    db.drop()
+    db = WorkerDatabase(template, setup=setup, version="1", verbose=False)
+    assert "template" not in db.timings
+    db.drop()
+    tables.append("bar")
+    db = WorkerDatabase(template, setup=setup, version="2", verbose=False)
+    assert table_names(db) == ["bar"]
+    db.drop()
+
+def test_worker_database_no_template(tmpdir):
+    with raises(ValueError):
+        WorkerDatabase("sqlite:///%s" % tmpdir.join("template.db"))
+
+def test_statement_tracker(tmpdir, caplog):
+    import logging
+    caplog.set_level(logging.INFO)
+    engine = make_db(tmpdir, "primary")
+    reports = []
+    ctx = AnyObject()
+    tracker = StatementTracker(engine, top=2, repeat_threshold=3, ctx_factory=lambda: ctx)
+    sm = SessionManager(engine, tracker=tracker, ctx_factory=lambda: ctx)
+    with sm() as s:
+        for i in range(3):
+            s.execute("select name from dbname where name = :name", {"name": i})
+        with sm(force_new=True) as s2:
+            s2.execute("select count(*) from dbname")
+        assert ctx.db_stats.count == 6    # including BEGIN statements
+        s.execute("select 1")
+    assert not hasattr(ctx, "db_stats")
+    assert "7 SQL statements in" in caplog.text
+    assert "Statement executed 3 times in one session (N+1 query?): " \
+        "select name from dbname where name = ?" in caplog.text
+
+    tracker.report = reports.append
+    with sm() as s:
+        pass
+    with sm() as s:
+        s.execute("select 1")
+    assert [r.count for r in reports] == [0, 2]
+    assert len(reports[1].slowest_statements()) == 2
+    assert reports[1].total_time > 0
+
+    # failed statements leave nothing behind on the connection
+    with sm() as s:
+        for i in range(5):
+            with raises(OperationalError):
+                s.execute("select * from nonexistent")
+        s.execute("select 1")
+        assert s.connection().info.get("pato_statement_start") is None
+    assert reports[2].count == 2
+
+def test_stream(tmpdir):
+    engine = make_db(tmpdir, "stream")
+    with engine.begin() as conn:
+        conn.execute("create table item (id integer, price float)")
+        conn.execute("insert into item values (:id, :price)",
+                     [{"id": i, "price": i * 1.5} for i in range(10)])
+    sm = SessionManager(engine, lazy=True)
+    with sm():
+        chunks = list(stream("select id, price from item where id < :n order by id", {"n": 7},
+                             chunk_size=3))
+        assert [len(c) for c in chunks] == [3, 3, 1]
+        assert tuple(chunks[2][0]) == (6, 9.0)
+
+        chunks = list(stream("select id, price from item order by id", chunk_size=4,
+                             columns=True, array_factory=tuple))
+        assert len(chunks) == 3
+        assert list(chunks[0]) == ["id", "price"]
+        assert chunks[0]["id"] == (0, 1, 2, 3)
+        assert chunks[2]["price"] == (12.0, 13.5)
+
+        assert list(stream("select id from item where id > 100")) == []